@@ -1,5 +1,15 @@
+import contextlib
+import hashlib
+import importlib.util
+import os
+import random
+import re
 import sys
 import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
 import ply.yacc as yacc
 import ply.lex as lex
 
@@ -69,8 +79,6 @@ def t_error(t):
     # raise Exception("Lexer Error")
 
 
-lexer = lex.lex()
-
 # data = '''project[dname](
 # select[dnumber="25"](department)
 # );'''
@@ -229,7 +237,309 @@ def p_error(p):
     # print("Syntax error: '%s'" % p.value)
 
 
-parser = yacc.yacc()
+# The lexer and parser are built on first use rather than at import, from
+# the pregenerated tables in lextab.py and parsetab.py: the token rules are
+# not re-validated and no table or parser.out file is written. After changing
+# the grammar or the token rules, regenerate both with
+#   python RAP.py --build-tables
+# PLY lexers and parsers keep their state in the object while parsing, so
+# every thread gets its own parser and its own clone of the lexer.
+TABLE_DIR = os.path.dirname(os.path.abspath(__file__))
+_parser_lock = threading.Lock()
+_master_lexer = None
+_parsers = threading.local()
+
+
+def get_parser():
+    parser = getattr(_parsers, 'parser', None)
+    if parser is None:
+        global _master_lexer
+        with _parser_lock:
+            if _master_lexer is None:
+                _master_lexer = lex.lex(optimize=True, lextab='lextab', outputdir=TABLE_DIR)
+            _parsers.lexer = _master_lexer.clone()
+            parser = _parsers.parser = yacc.yacc(debug=False, write_tables=False)
+    return parser
+
+
+def get_lexer():
+    get_parser()
+    return _parsers.lexer
+
+
+def build_tables():
+    for name in ['lextab.py', 'parsetab.py']:
+        if os.path.exists(os.path.join(TABLE_DIR, name)):
+            os.remove(os.path.join(TABLE_DIR, name))
+    lex.lex(optimize=True, lextab='lextab', outputdir=TABLE_DIR)
+    yacc.yacc(debug=True, outputdir=TABLE_DIR)
+
+
+# Stands in for the PLY parser so that parser.parse(data) uses the parser of
+# the calling thread, building it on first use
+class LazyParser():
+
+    def parse(self, data, **kwargs):
+        return get_parser().parse(data, lexer=get_lexer(), **kwargs)
+
+
+parser = LazyParser()
+
+
+# ------------------------ Timing instrumentation ---------------------------
+# Phase times of the query run by the current thread, collected between
+# start_timing() and stop_timing(). Outside of that, timed() only costs a
+# thread-local lookup.
+
+_timing = threading.local()
+
+
+def start_timing():
+    _timing.phases = OrderedDict()
+
+
+# {phase: seconds} collected since start_timing(), in first-seen order
+def stop_timing():
+    phases = getattr(_timing, 'phases', None)
+    _timing.phases = None
+    return phases if phases is not None else OrderedDict()
+
+
+@contextlib.contextmanager
+def timed(phase):
+    phases = getattr(_timing, 'phases', None)
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[phase] = phases.get(phase, 0.0) + time.perf_counter() - start
+
+
+# batches with the time spent producing each one added to phase
+def timed_batches(batches, phase):
+    while True:
+        with timed(phase):
+            records = next(batches, None)
+        if records is None:
+            return
+        yield records
+
+
+def format_timing(phases):
+    return ", ".join([phase + " " + "%.3f" % (seconds * 1000) + " ms"
+                      for phase, seconds in phases.items()]) + \
+        ", total " + "%.3f" % (sum(phases.values()) * 1000) + " ms"
+
+
+# ------------------------ Connection pool and schema catalog ----------------
+# Connections are pooled per database file, and the schema of every file is
+# cached keyed by its path and PRAGMA schema_version, so opening a database
+# does not reconnect and re-run pragma_table_info for every relation.
+
+POOL_SIZE = 4
+
+_pool_lock = threading.Lock()
+_pools = {}             # abs path -> list of idle connections
+_schema_catalog = {}    # abs path -> (schema_version, {table: [(name, type, pk)]})
+_keyed_relations = {}   # abs path -> (data_version, set of RNAMEs)
+_materialized = {}      # id(conn) -> (data_version, OrderedDict of TEMP tables)
+
+
+def get_connection(dbfile):
+    path = os.path.abspath(dbfile)
+    with _pool_lock:
+        idle = _pools.setdefault(path, [])
+        if idle:
+            return idle.pop()
+    # connections are handed to one user at a time, so they may move
+    # between the threads of the Dash server
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+def release_connection(dbfile, conn):
+    path = os.path.abspath(dbfile)
+    with _pool_lock:
+        idle = _pools.setdefault(path, [])
+        if len(idle) < POOL_SIZE:
+            idle.append(conn)
+            return
+        _materialized.pop(id(conn), None)
+    conn.close()
+
+
+def get_schema_catalog(dbfile, conn):
+    path = os.path.abspath(dbfile)
+    version = conn.execute("pragma schema_version").fetchone()[0]
+    with _pool_lock:
+        entry = _schema_catalog.get(path)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    tables = {}
+    c = conn.cursor()
+    c.execute("select name from sqlite_schema where type='table' and name not like 'sqlite\\_%' escape '\\'")
+    for record in c.fetchall():
+        c.execute("select name,type,pk from pragma_table_info(?)", (record[0],))
+        tables[record[0]] = c.fetchall()
+    c.close()
+    with _pool_lock:
+        _schema_catalog[path] = (version, tables)
+    return tables
+
+
+# A dedicated connection per file is used to read PRAGMA data_version. The
+# value only changes for a connection when another connection commits, so
+# keeping one connection aside makes it see writes from the pool and from
+# other processes alike.
+_version_conns = {}
+
+
+def get_data_version(dbfile):
+    path = os.path.abspath(dbfile)
+    with _pool_lock:
+        conn = _version_conns.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            _version_conns[path] = conn
+        return conn.execute("pragma data_version").fetchone()[0]
+
+
+# ------------------------ Query result cache --------------------------------
+# Bounded LRU cache of query results shared by all sessions. Entries are
+# keyed by database path, data_version and the SQL with its TEMP_N aliases
+# renumbered, so the same subtree hits the cache whatever names it was given.
+
+class ResultCache():
+
+    def __init__(self, max_rows=200000, max_bytes=64*1024*1024):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # key -> (value, rows, bytes)
+        self.rows = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, rows, size):
+        if rows > self.max_rows or size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.rows -= old[1]
+                self.bytes -= old[2]
+            self.entries[key] = (value, rows, size)
+            self.rows += rows
+            self.bytes += size
+            while self.rows > self.max_rows or self.bytes > self.max_bytes:
+                _, (_, r, b) = self.entries.popitem(last=False)
+                self.rows -= r
+                self.bytes -= b
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.rows = 0
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'rows': self.rows,
+                    'bytes': self.bytes}
+
+
+result_cache = ResultCache()
+
+
+# Renumber TEMP_N aliases in order of appearance; string literals are left
+# untouched.
+def canonical_sql(query):
+    return rename_temps(query, canonical_names(query))
+
+
+# {TEMP_N of query: its name in canonical_sql(query)}
+def canonical_names(query):
+    names = {}
+    for tok in re.findall(r"'[^']*'|\bTEMP_\d+\b", query):
+        if not tok.startswith("'") and tok not in names:
+            names[tok] = 'TEMP_' + str(len(names))
+    return names
+
+
+def rename_temps(text, names):
+    return re.sub(r"'[^']*'|\bTEMP_\d+\b",
+                  lambda m: names.get(m.group(0), m.group(0)), text)
+
+
+# Execute query on db and return (columns, records), going through
+# result_cache when the database file is known. key_sql is the SQL used for
+# the cache key when query reads materialized tables; query may then be a
+# function returning the SQL, called only when the result is not cached.
+# mode tells apart the ways of running key_sql (get_node_info_from_db), which
+# are cached separately.
+def execute_cached(db, query, params=(), key_sql=None, mode=()):
+    key = None
+    if db.dbfile is not None:
+        key = (os.path.abspath(db.dbfile), get_data_version(db.dbfile),
+               canonical_sql(key_sql or query), tuple(params), tuple(mode))
+        with timed('cache lookup'):
+            cached = result_cache.get(key)
+        if cached is not None:
+            return cached
+
+    if callable(query):
+        query = query()
+    c = db.conn.cursor()
+    with timed('execute'):
+        c.execute(query, params)
+    with timed('fetch'):
+        records = c.fetchall()
+    columns = [desc[0] for desc in c.description]
+    c.close()
+
+    if key is not None:
+        size = len(key[2]) + \
+            sum(sys.getsizeof(val) for record in records for val in record)
+        result_cache.put(key, (columns, records), len(records), size)
+    return columns, records
+
+
+# Relations with a primary key holding no NULLs; their rows are distinct.
+def get_keyed_relations(dbfile, conn):
+    path = os.path.abspath(dbfile)
+    version = get_data_version(dbfile)
+    entry = _keyed_relations.get(path)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    keyed = set()
+    c = conn.cursor()
+    for name, records in get_schema_catalog(dbfile, conn).items():
+        pk = [record[0] for record in records if record[2] > 0]
+        if len(pk) == 0:
+            continue
+        c.execute('select count(*) from (select 1 from "' + name + '" where ' +
+                  ' or '.join('"' + col + '" is null' for col in pk) + ' limit 1)')
+        if c.fetchone()[0] == 0:
+            keyed.add(name.upper())
+    c.close()
+    _keyed_relations[path] = (version, keyed)
+    return keyed
 
 
 class SQLite3():
@@ -239,19 +549,19 @@ class SQLite3():
         self.attributes = {}
         self.domains = {}
         self.conn = None
+        self.dbfile = None
+        self.keyed = None
 
     def open(self, dbfile):
-        self.conn = sqlite3.connect(dbfile)
-        query = "select name from sqlite_schema where type='table'"
-        c = self.conn.cursor()
-        c.execute(query)
-        records = c.fetchall()
-        for record in records:
-            self.relations.append(record[0].upper())
-        for rname in self.relations:
-            query = "select name,type from pragma_table_info('"+rname+"')"
-            c.execute(query)
-            records = c.fetchall()
+        self.dbfile = dbfile
+        self.conn = get_connection(dbfile)
+        self.keyed = None
+        self.relations = []
+        self.attributes = {}
+        self.domains = {}
+        for name, records in get_schema_catalog(dbfile, self.conn).items():
+            rname = name.upper()
+            self.relations.append(rname)
             attrs = []
             doms = []
             for record in records:
@@ -265,8 +575,15 @@ class SQLite3():
             self.attributes[rname] = attrs
             self.domains[rname] = doms
 
+    def keyedRelations(self):
+        if self.keyed is None:
+            self.keyed = get_keyed_relations(self.dbfile, self.conn)
+        return self.keyed
+
     def close(self):
-        self.conn.close()
+        if self.conn is not None:
+            release_connection(self.dbfile, self.conn)
+            self.conn = None
 
     def relationExists(self, rname):
         return rname in self.relations
@@ -291,6 +608,20 @@ class SQLite3():
         print("*********************************************")
 
     def displayQueryResults(self, query, tree):
+        # execute the query against sqlite3 database
+        c = self.conn.cursor()
+        # print("Executing query:",query)
+        with timed('execute'):
+            c.execute(query)
+        self.displayRecords(tree, timed_batches(iter(lambda: c.fetchmany(DISPLAY_BATCH), []),
+                                                'fetch'))
+        c.close()
+
+    # print the answer from batches of records. An answer of one batch is
+    # printed after its number of tuples; a longer one is counted while it
+    # is written and its number of tuples follows the last batch, so the
+    # query runs once
+    def displayRecords(self, tree, batches):
         print("\nANSWER(", end="")
         nCols = len(tree.get_attributes())
         for i, col in enumerate(tree.get_attributes()):
@@ -298,19 +629,30 @@ class SQLite3():
                 print(col+":"+tree.get_domains()[i]+")")
             else:
                 print(col+":"+tree.get_domains()[i]+",", end="")
-        # execute the query against sqlite3 database
-        c = self.conn.cursor()
-        # print("Executing query:",query)
-        c.execute(query)
-        records = c.fetchall()
-        rowCount = len(records)
-        print("Number of tuples = "+str(rowCount)+"\n")
-        for record in records:
-            for val in record:
-                print(str(val)+":", end="")
+        mode, n = display_mode
+        if mode == 'sample':
+            rowCount, records = sample_records(batches, n)
+            print("Number of tuples = "+str(rowCount)+"\n")
+            write_records(records)
+            print()
+            return
+        records = next(batches, [])
+        if mode != 'stream' and len(records) < DISPLAY_BATCH:
+            print("Number of tuples = "+str(len(records))+"\n")
+            write_records(records if mode == 'all' else records[:n])
             print()
+            return
+        print()
+        rowCount = 0
+        while records:
+            if mode != 'first':
+                write_records(records)
+            elif rowCount < n:
+                write_records(records[:n - rowCount])
+            rowCount += len(records)
+            records = next(batches, [])
+        print("Number of tuples = "+str(rowCount))
         print()
-        c.close()
 
     def isQueryResultEmpty(self, query):
         c = self.conn.cursor()
@@ -319,7 +661,39 @@ class SQLite3():
         return len(records) == 0
 
 
+# Column name, domain and condition lists set on nodes are interned: equal
+# lists are one shared NameList, so the schema repeated at every node of a
+# large tree is stored once. Shared lists cannot be modified in place.
+class NameList(list):
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("column lists of nodes are shared and cannot be modified")
+
+    append = extend = insert = remove = pop = clear = sort = reverse = _immutable
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+
+    # pickle and copy rebuild lists by appending to them
+    def __reduce__(self):
+        return (intern_names, (list(self),))
+
+
+_name_lists = weakref.WeakValueDictionary()
+
+
+def intern_names(names):
+    if names is None or isinstance(names, NameList):
+        return names
+    key = tuple(names)
+    interned = _name_lists.get(key)
+    if interned is None:
+        interned = NameList(names)
+        _name_lists[key] = interned
+    return interned
+
+
 class Node:
+    __slots__ = ('node_type', 'left_child', 'right_child', 'columns', 'conditions',
+                 'relation_name', 'attributes', 'domains', 'join_columns', 'distinct')
 
     def __init__(self, ntype, lc, rc):
         self.node_type = ntype		# "relation", "select", "project", "times",...
@@ -334,7 +708,10 @@ class Node:
         self.relation_name = None
         self.attributes = None		# holds schema attributes at node
         self.domains = None			# holds schema domains of attributes at node
-        self.join_columns = []		# holds common column names for join
+        self.join_columns = intern_names([])		# holds common column names for join
+        # False for projections added by the optimizer that only narrow
+        # their input and leave duplicate elimination to an ancestor
+        self.distinct = True
 
     def get_attributes(self):
         return self.attributes
@@ -364,9 +741,11 @@ class Node:
         return self.join_columns
 
     def set_attributes(self, attributes):
-        self.attributes = attributes
+        self.attributes = intern_names(attributes)
 
     def set_conditions(self, conditions):
+        if conditions is not None:
+            conditions = intern_names([tuple(condition) for condition in conditions])
         self.conditions = conditions
 
     def set_right_child(self, right_node):
@@ -376,10 +755,10 @@ class Node:
         self.left_child = left_node
 
     def set_columns(self, cols):
-        self.columns = cols
+        self.columns = intern_names(cols)
 
     def set_domains(self, doms):
-        self.domains = doms
+        self.domains = intern_names(doms)
 
     def set_node_type(self, n_type):
         self.node_type = n_type
@@ -388,7 +767,7 @@ class Node:
         self.relation_name = r_name
 
     def set_join_columns(self, jc):
-        self.join_columns = jc
+        self.join_columns = intern_names(jc)
 
     def print_tree(self, n):
         if self.node_type == "relation":
@@ -463,8 +842,27 @@ class Node:
 # from Node import *
 # from SQLite3 import *
 
-# Global variable used for setting temporary table names
-count = 0
+# Temp table names are allocated per tree: set_temp_table_names numbers the
+# interior nodes of a tree from TEMP_0, and nodes the optimizer adds to a tree
+# continue after its largest number (continue_temp_names). The next number
+# is kept per thread, so concurrent requests neither share nor race on it.
+_temp_names = threading.local()
+
+# Index advice for CLI queries: 'off', 'report' (list missing indexes),
+# 'temp' (create them for the query only) or 'persist' (create and keep)
+index_advice = 'off'
+INDEX_BUDGET = 64*1024*1024     # bytes of new indexes allowed per query
+
+# Backend CLI queries run on: 'sqlite' or 'columnar'
+query_backend = 'sqlite'
+
+# How CLI answers are printed: ('all', None), ('stream', None) to always
+# print the tuple count after the tuples, ('first', n) or ('sample', n)
+display_mode = ('all', None)
+DISPLAY_BATCH = 1000     # tuples fetched and written at a time
+
+# Print the phase times of every CLI query ("timing on;")
+timing_enabled = False
 
 
 def execute_file(filename, db):
@@ -473,22 +871,108 @@ def execute_file(filename, db):
             data = f.read().splitlines()
         result = " ".join(
             list(filter(lambda x: len(x) > 0 and x[0] != "#", data)))
-        try:
-            tree = parser.parse(result)
-            set_temp_table_names(tree)
-            msg = semantic_checks(tree, db)
-            if msg == 'OK':
-                query = generateSQL(tree, db)
-                db.displayQueryResults(query, tree)
-            else:
-                print(msg)
-        except Exception as inst:
-            print(inst.args[0])
+        run_query(result, db)
     except FileNotFoundError:
         print("FileNotFoundError: A file with name " + "'" +
               filename + "' cannot be found")
 
 
+# Parse, check and run one query, printing its phase times when timing is on
+def run_query(data, db):
+    if timing_enabled:
+        start_timing()
+    try:
+        with timed('parse'):
+            tree = parser.parse(data)
+        # print("********************************")
+        # tree.print_tree(0)
+        # print("********************************")
+        with timed('check'):
+            set_temp_table_names(tree)
+            msg = semantic_checks(tree, db)
+        if msg == 'OK':
+            # print('Passed semantic checks')
+            execute_query(tree, db)
+        else:
+            print(msg)
+    except Exception as inst:
+        print(inst.args[0])
+    finally:
+        if timing_enabled:
+            print("Timing: " + format_timing(stop_timing()) + "\n")
+
+
+# Optimize and run a checked tree, applying the index advice mode
+def execute_query(tree, db):
+    with timed('optimize'):
+        optimized = optimize_tree(tree, db)
+    if query_backend == 'columnar':
+        with timed('columnar'):
+            records = evaluate_columnar(optimized, db).rows()
+        db.displayRecords(tree, (records[i:i + DISPLAY_BATCH]
+                                 for i in range(0, len(records), DISPLAY_BATCH)))
+        return
+    temp = False
+    if index_advice != 'off':
+        with timed('index advice'):
+            advice = advise_indexes(optimized, db)
+            display_index_advice(advice)
+            if index_advice in ['temp', 'persist'] and len(advice) > 0:
+                temp = create_advised_indexes(advice, db) and index_advice == 'temp'
+    try:
+        with timed('generate sql'):
+            query = generateCTESQL(optimized, db)
+        db.displayQueryResults(query, tree)
+    finally:
+        if temp:
+            db.conn.execute("rollback to index_advice")
+            db.conn.execute("release index_advice")
+
+
+# Create the advised indexes in the 'temp' or 'persist' mode, in the savepoint
+# index_advice. 'persist' commits them; 'temp' leaves the savepoint open and
+# execute_query rolls it back after the query, so the indexes are never
+# written to the database file, not even when the CLI is killed. A database
+# the indexes cannot be written to turns the advice to 'report'. Returns
+# whether the indexes were created.
+def create_advised_indexes(advice, db):
+    global index_advice
+    db.conn.execute("savepoint index_advice")
+    try:
+        create_indexes(advice, db, INDEX_BUDGET)
+    except sqlite3.OperationalError as inst:
+        db.conn.execute("rollback to index_advice")
+        db.conn.execute("release index_advice")
+        print("Index advice: cannot create indexes (" + str(inst) + "), reporting only")
+        index_advice = 'report'
+        return False
+    if index_advice == 'persist':
+        db.conn.execute("release index_advice")
+    return True
+
+
+def write_records(records):
+    with timed('output'):
+        sys.stdout.write("".join([":".join(map(str, record)) + ":\n" for record in records]))
+
+
+# number of records in batches and a uniform sample of n of them, in order
+def sample_records(batches, n):
+    rng = random.Random(0)
+    sample = []
+    seen = 0
+    for records in batches:
+        for record in records:
+            if len(sample) < n:
+                sample.append((seen, record))
+            else:
+                k = rng.randrange(seen + 1)
+                if k < n:
+                    sample[k] = (seen, record)
+            seen += 1
+    return seen, [record for _, record in sorted(sample, key=lambda item: item[0])]
+
+
 def read_input():
     result = ''
     data = input('RA: ').strip()
@@ -503,20 +987,96 @@ def read_input():
     return result
 
 
+def next_temp_name():
+    number = getattr(_temp_names, 'next', 0)
+    _temp_names.next = number + 1
+    return 'TEMP_' + str(number)
+
+
 def set_temp_table_names(tree):
-    if tree != None and tree.get_node_type() != 'relation':
-        global count
-        set_temp_table_names(tree.get_left_child())
-        tree.set_relation_name('TEMP_' + str(count))
-        count += 1
-        if tree.right_child != None:
-            set_temp_table_names(tree.get_right_child())
+    _temp_names.next = 0
+    name_interior_nodes(tree)
+
+
+# interior nodes are numbered in order: left subtree, node, right subtree
+def name_interior_nodes(tree):
+    stack = []
+    node = tree
+    while True:
+        while node is not None and node.get_node_type() != 'relation':
+            stack.append(node)
+            node = node.get_left_child()
+        if len(stack) == 0:
+            return
+        node = stack.pop()
+        node.set_relation_name(next_temp_name())
+        node = node.get_right_child()
+
+
+# make next_temp_name continue after the largest TEMP_N in tree
+def continue_temp_names(tree):
+    _temp_names.next = largest_temp_number(tree) + 1
+
+
+def largest_temp_number(tree):
+    largest = -1
+    for node in postorder(tree):
+        name = node.get_relation_name() or ''
+        if node.get_node_type() != 'relation' and re.fullmatch(r'TEMP_\d+', name):
+            largest = max(largest, int(name[5:]))
+    return largest
+
+
+# Structural hashes of the subtrees of tree, by id(node): two subtrees have
+# the same hash when they compute the same result, whatever TEMP names and
+# qualified attributes they were given. The hash of a node covers its own
+# operation and the hashes of its children, so hashing a tree takes time
+# linear in its size, and the hashes can key caches across trees and threads.
+def structure_keys(tree):
+    keys = {}
+    for node in postorder(tree):
+        ntype = node.get_node_type()
+        fields = [ntype, node.get_relation_name() if ntype == 'relation' else None,
+                  node.get_columns(), [list(c) for c in node.get_conditions() or []],
+                  node.distinct,
+                  keys.get(id(node.get_left_child())), keys.get(id(node.get_right_child()))]
+        keys[id(node)] = hashlib.sha1(repr(fields).encode()).hexdigest()
+    return keys
+
+
+# the nodes of tree, every node after its children and left subtrees before
+# right ones. The passes over whole trees walk this list instead of recursing,
+# so that machine generated trees thousands of nodes deep stay clear of the
+# recursion limit. Nodes for which expand is false are listed without their
+# subtrees.
+def postorder(tree, expand=None):
+    order = []
+    stack = [tree] if tree is not None else []
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        if expand is None or expand(node):
+            if node.get_left_child() is not None:
+                stack.append(node.get_left_child())
+            if node.get_right_child() is not None:
+                stack.append(node.get_right_child())
+    order.reverse()
+    return order
 
 # perform semantic checks; set tree.attributes and tree.domains along the way
 # return "OK" or ERROR message
 
 
 def semantic_checks(tree, db):
+    for node in postorder(tree):
+        status = check_node(node, db)
+        if status != 'OK':
+            return status
+    return 'OK'
+
+
+# semantic checks of one node whose children have passed theirs
+def check_node(tree, db):
     if tree.get_node_type() == 'relation':
         rname = tree.get_relation_name()
         if not db.relationExists(rname):
@@ -526,9 +1086,6 @@ def semantic_checks(tree, db):
         return 'OK'
 
     if tree.get_node_type() == 'select':
-        status = semantic_checks(tree.get_left_child(), db)
-        if status != 'OK':
-            return status
         conditions = tree.get_conditions()
         attrs = tree.get_left_child().get_attributes()
         doms = tree.get_left_child().get_domains()
@@ -558,12 +1115,6 @@ def semantic_checks(tree, db):
         return 'OK'
 
     if tree.get_node_type() == 'times':
-        status = semantic_checks(tree.get_left_child(), db)
-        if status != 'OK':
-            return status
-        status = semantic_checks(tree.get_right_child(), db)
-        if status != 'OK':
-            return status
 
         lattrs = tree.get_left_child().get_attributes()
         rattrs = tree.get_right_child().get_attributes()
@@ -594,12 +1145,6 @@ def semantic_checks(tree, db):
         return 'OK'
 
     if tree.get_node_type() in ['union', 'intersect', 'minus']:
-        status = semantic_checks(tree.get_left_child(), db)
-        if status != 'OK':
-            return status
-        status = semantic_checks(tree.get_right_child(), db)
-        if status != 'OK':
-            return status
 
         lattrs = tree.get_left_child().get_attributes()
         rattrs = tree.get_right_child().get_attributes()
@@ -620,12 +1165,6 @@ def semantic_checks(tree, db):
         return 'OK'
 
     if tree.get_node_type() == 'join':
-        status = semantic_checks(tree.get_left_child(), db)
-        if status != 'OK':
-            return status
-        status = semantic_checks(tree.get_right_child(), db)
-        if status != 'OK':
-            return status
 
         lattrs = tree.get_left_child().get_attributes()
         rattrs = tree.get_right_child().get_attributes()
@@ -653,9 +1192,6 @@ def semantic_checks(tree, db):
         return 'OK'
 
     if tree.get_node_type() == 'project':
-        status = semantic_checks(tree.get_left_child(), db)
-        if status != 'OK':
-            return status
 
         p_attrs = tree.get_columns()
         attrs = tree.get_left_child().get_attributes()
@@ -680,9 +1216,6 @@ def semantic_checks(tree, db):
 
 
     if tree.get_node_type() == 'rename':
-        status = semantic_checks(tree.get_left_child(), db)
-        if status != 'OK':
-            return status
         r_attrs = tree.get_columns()
         attrs = tree.get_left_child().get_attributes()
         doms = tree.get_left_child().get_domains()
@@ -710,59 +1243,104 @@ def semantic_checks(tree, db):
         return 'OK'
 
 # given the relational algebra expression tree, generate an equivalent
-# sqlite3 query.
-
-
-def generateSQL(tree, db):
+# sqlite3 query. Nodes whose relation name is a key of materialized are read
+# from the TEMP table it maps to instead of being expanded.
+
+
+# FROM clause item for child: its TEMP table or CTE when it is materialized,
+# otherwise the subquery text, aliased by the child's relation name.
+def from_item(child, query, materialized):
+    name = child.get_relation_name()
+    if materialized and name in materialized:
+        if materialized[name] == name:
+            return name
+        return materialized[name]+" "+name
+    return "("+query+") "+name
+
+
+def generateSQL(tree, db, materialized=None):
+    return subtree_sql(tree, db, materialized, keep=False)[id(tree)]
+
+
+# SQL of every node of tree, by id(node). Without keep only the root's is
+# returned, the SQL of a node being dropped once its parent's is built.
+def subtree_sql(tree, db, materialized=None, keep=True):
+    queries = {}
+    for node in postorder(tree, lambda node: not (
+            materialized and node.get_relation_name() in materialized)):
+        # children read from materialized have no SQL of their own
+        take = queries.get if keep else queries.pop
+        lquery = take(id(node.get_left_child()), None)
+        rquery = take(id(node.get_right_child()), None)
+        queries[id(node)] = node_sql(node, db, materialized, lquery, rquery)
+    return queries
+
+
+# SQL of one node given the SQL of its children, lquery and rquery (None for
+# children read from materialized)
+def node_sql(tree, db, materialized, lquery, rquery):
+    if materialized and tree.get_relation_name() in materialized:
+        return "select * from "+materialized[tree.get_relation_name()]
     if tree.get_node_type() == 'relation':
         return "select * from "+tree.get_relation_name()
-    elif tree.get_node_type() == "union":
-        lquery = generateSQL(tree.get_left_child(), db)
-        rquery = generateSQL(tree.get_right_child(), db)
-        return lquery+" union "+rquery
+    elif tree.get_node_type() in ["union", "intersect", "minus"]:
+        # compound operators associate to the left, so a compound right
+        # operand is read through a subquery unless regrouping it leaves the
+        # result the same: a union under a union or an intersect under an
+        # intersect
+        rtype = tree.get_right_child().get_node_type()
+        if rtype in ["union", "intersect", "minus"] and \
+                (tree.get_node_type() == "minus" or rtype != tree.get_node_type()):
+            rquery = "select * from ("+rquery+")"
+        if tree.get_node_type() == "union":
+            return lquery+" union "+rquery
+        # reading the left operand through its alias keeps its column names
+        lquery = "select * from " + \
+            from_item(tree.get_left_child(), lquery, materialized)
+        if tree.get_node_type() == "intersect":
+            return lquery+" intersect "+rquery
+        return lquery+" except "+rquery
     elif tree.get_node_type() == "times":
-        lquery = generateSQL(tree.get_left_child(), db)
         if tree.get_left_child().get_node_type() == "union":
             lquery = "("+lquery+")"
-        rquery = generateSQL(tree.get_right_child(), db)
         if tree.get_right_child().get_node_type() == "union":
             rquery = "("+rquery+")"
         return "select * from " + \
-               "(("+lquery+") "+tree.get_left_child().get_relation_name()+"), " + \
-               "(("+rquery+") "+tree.get_right_child().get_relation_name()+")"
+               "("+from_item(tree.get_left_child(), lquery, materialized)+"), " + \
+               "("+from_item(tree.get_right_child(), rquery, materialized)+")"
     elif tree.get_node_type() == "project":
-        lquery = generateSQL(tree.get_left_child(), db)
         query = "select "
 
         for attr in tree.get_columns():
             query += f"{attr}, "
 
         query = query[:-2] 
-        query += f" from ({lquery})"
+        if materialized and tree.get_left_child().get_relation_name() in materialized:
+            query += " from " + materialized[tree.get_left_child().get_relation_name()]
+        else:
+            query += f" from ({lquery})"
 
         non_aggregate_cols = [col for col in tree.get_columns() if '(' not in col]
-        if non_aggregate_cols:
+        if non_aggregate_cols and tree.distinct:
             query += f" group by {', '.join(non_aggregate_cols)}"
 
         return query
 
     elif tree.get_node_type() == "rename":
-        lquery = generateSQL(tree.get_left_child(), db)
         if tree.get_left_child().get_node_type() == "union":
             lquery = "("+lquery+")"
         query = "select "
         for i, attr in enumerate(tree.get_attributes()):
             query += tree.get_left_child().get_attributes()[i]+" "+attr+", "
         query = query[:-2]
-        query += " from ("+lquery+") " + \
-            tree.get_left_child().get_relation_name()
+        query += " from " + \
+            from_item(tree.get_left_child(), lquery, materialized)
         return query
     elif tree.get_node_type() == "select":
-        lquery = generateSQL(tree.get_left_child(), db)
         if tree.get_left_child().get_node_type() == "union":
             lquery = "("+lquery+")"
-        query = "select * from (("+lquery+") " + \
-            tree.get_left_child().get_relation_name()+") where "
+        query = "select * from (" + \
+            from_item(tree.get_left_child(), lquery, materialized)+") where "
         for condition in tree.get_conditions():
             c1 = condition[1]
             if condition[0] == 'str':
@@ -779,71 +1357,1388 @@ def generateSQL(tree, db):
         return query
 
     elif tree.get_node_type() == "join":
-        lquery = generateSQL(tree.get_left_child(), db)
         if tree.get_left_child().get_node_type() == "union":
             lquery = "("+lquery+")"
-        rquery = generateSQL(tree.get_right_child(), db)
         if tree.get_right_child().get_node_type() == "union":
             rquery = "("+rquery+")"
-        query = "select distinct "
+        # a natural join of two sets is a set
+        if duplicate_free(tree.get_left_child(), db) and \
+                duplicate_free(tree.get_right_child(), db):
+            query = "select "
+        else:
+            query = "select distinct "
         for attr in tree.get_attributes():
             if attr in tree.get_join_columns():
                 query += tree.get_left_child().get_relation_name()+"."+attr+", "
             else:
                 query += attr+", "
         query = query[:-2]
-        query += " from " + \
-                 "("+lquery+") "+tree.get_left_child().get_relation_name()+", " + \
-                 "("+rquery+") "+tree.get_right_child().get_relation_name()
         if len(tree.get_join_columns()) == 0:
+            query += " from " + \
+                     from_item(tree.get_left_child(), lquery, materialized)+", " + \
+                     from_item(tree.get_right_child(), rquery, materialized)
             return query
-        query += " where "
-        for col in tree.get_join_columns():
-            query += tree.get_left_child().get_relation_name()+"."+col+"=" + \
-                tree.get_right_child().get_relation_name()+"."+col+" and "
-        query = query[:-5]
+        query += " from " + \
+                 from_item(tree.get_left_child(), lquery, materialized)+" join " + \
+                 from_item(tree.get_right_child(), rquery, materialized) + \
+                 " using ("+", ".join(tree.get_join_columns())+")"
         return query
-    elif tree.get_node_type() == "intersect":
-        lquery = generateSQL(tree.get_left_child(), db)
-        if tree.get_left_child().get_node_type() == "union":
-            lquery = "("+lquery+")"
-        rquery = generateSQL(tree.get_right_child(), db)
-        if tree.get_right_child().get_node_type() == "union":
-            rquery = "("+rquery+")"
-        query = "select * from ("+lquery+") "+tree.get_left_child().get_relation_name() + \
-                " where ("
-        for attr in tree.get_attributes():
-            query += attr+", "
-        query = query[:-2] + ") in "
-        query += "(select * from ("+rquery+") " + \
-            tree.get_right_child().get_relation_name()
-        query += ")"
+
+
+# does the result of tree hold no duplicate rows?
+def duplicate_free(tree, db):
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        ntype = node.get_node_type()
+        if ntype == 'relation':
+            if node.get_relation_name() not in db.keyedRelations():
+                return False
+        elif ntype == 'project':
+            # grouped (or aggregated to a single row) unless only narrowing
+            if not node.distinct:
+                return False
+        elif ntype == 'times':
+            stack.append(node.get_right_child())
+            stack.append(node.get_left_child())
+        elif ntype not in ['join', 'union', 'intersect', 'minus']:
+            stack.append(node.get_left_child())
+    return True
+
+# SQLite inlines a CTE into the query reading it, and inlining all of a deep
+# tree exceeds its limits on the tables of a join and the depth of an
+# expression, so the CTEs of deeper trees are evaluated on their own (AS
+# MATERIALIZED, SQLite 3.35 and later)
+CTE_INLINE_DEPTH = 32
+
+# Evaluate identical subtrees once (generateCTESQL)
+share_subexpressions = True
+
+# Generate the query of generateSQL as a single WITH statement: every
+# interior node below the root becomes a common table expression named after
+# its TEMP_N and is referenced by name instead of copied into its parent.
+# Identical subtrees are common subexpressions: only the first of them is
+# evaluated, the CTEs of the others read its CTE, and a CTE read more than
+# once is evaluated once (AS MATERIALIZED).
+def generateCTESQL(tree, db):
+    ctes = []
+    query = cte_body(tree, db, ctes)
+    return with_ctes(ctes, query)
+
+
+# query preceded by the CTEs (name, SQL, materialize) it reads
+def with_ctes(ctes, query):
+    if len(ctes) == 0:
         return query
+    hints = sqlite3.sqlite_version_info >= (3, 35, 0)
+    return "with " + ", ".join(
+        name + (" as materialized (" if hints and materialize else " as (") + body + ")"
+        for name, body, materialize in ctes) + " " + query
+
+
+# SQL of tree reading its interior nodes from the CTEs added to ctes as
+# (name, SQL, materialize), every CTE after those it reads
+def cte_body(tree, db, ctes):
+    shared = shared_subtrees(tree) if share_subexpressions else {}
+    order = postorder(tree, lambda node: id(node) not in shared)
+    reused = set(id(shared[id(node)]) for node in order if id(node) in shared)
+    deep = tree_depth(tree) > CTE_INLINE_DEPTH
+    for node in order:
+        if id(node) in shared:
+            ctes.append((node.get_relation_name(),
+                         "select * from " + shared[id(node)].get_relation_name(), False))
+        elif node is not tree and node.get_node_type() != 'relation':
+            ctes.append((node.get_relation_name(), cte_query(node, db),
+                         deep or id(node) in reused))
+    return cte_query(tree, db)
+
+
+# SQL of tree reading its interior children from their CTEs
+def cte_query(tree, db):
+    names = {}
+    for child in [tree.get_left_child(), tree.get_right_child()]:
+        if child is not None and child.get_node_type() != 'relation':
+            names[child.get_relation_name()] = child.get_relation_name()
+    return generateSQL(tree, db, names)
+
+
+# The CTE SQL of every node of tree, as generateCTESQL gives it, in postorder
+# as (node, SQL, names); names are the TEMP names of the interior nodes of
+# the node's subtree in postorder. The SQL of each node (cte_query) is built
+# once, and a node's statement is put together from those of its subtree, as
+# index_cte_sql does, instead of rebuilding the subtree for every node. The
+# SQL and names of nodes with more than max_nodes nodes in their subtree are
+# None.
+def subtree_cte_sql(tree, db, max_nodes=None):
+    order = postorder(tree)
+    keys = structure_keys(tree)
+    sizes = {id(None): 0}
+    depths = {id(None): 0}
+    queries = {}
+    for node in order:
+        left, right = id(node.get_left_child()), id(node.get_right_child())
+        sizes[id(node)] = 1 + sizes[left] + sizes[right]
+        depths[id(node)] = 1 + max(depths[left], depths[right])
+        queries[id(node)] = cte_query(node, db)
+
+    for end, node in enumerate(order):
+        if max_nodes is not None and sizes[id(node)] > max_nodes:
+            yield node, None, None
+            continue
+        subtree = order[end + 1 - sizes[id(node)]:end + 1]
+        # common subexpressions within the subtree, as in shared_subtrees
+        first = {}
+        shared = {}
+        for other in subtree:
+            if share_subexpressions and other.get_node_type() != 'relation':
+                if keys[id(other)] in first:
+                    shared[id(other)] = first[keys[id(other)]]
+                else:
+                    first[keys[id(other)]] = other
+        # the subtree in postorder without the subtrees of common
+        # subexpressions: in reverse postorder the nodes below a node follow it
+        visited = []
+        i = len(subtree) - 1
+        while i >= 0:
+            visited.append(subtree[i])
+            i -= sizes[id(subtree[i])] if id(subtree[i]) in shared else 1
+        visited.reverse()
+
+        reused = set(id(shared[id(other)]) for other in visited if id(other) in shared)
+        deep = depths[id(node)] > CTE_INLINE_DEPTH
+        ctes = []
+        for other in visited[:-1]:
+            if id(other) in shared:
+                ctes.append((other.get_relation_name(),
+                             "select * from " + shared[id(other)].get_relation_name(), False))
+            elif other.get_node_type() != 'relation':
+                ctes.append((other.get_relation_name(), queries[id(other)],
+                             deep or id(other) in reused))
+        names = [other.get_relation_name() for other in subtree
+                 if other.get_node_type() != 'relation']
+        yield node, with_ctes(ctes, queries[id(node)]), names
+
+
+# Common subexpressions of a checked tree: every interior node computing the
+# same result as an earlier node in postorder (structure_keys), mapped to
+# that first node.
+def shared_subtrees(tree):
+    keys = structure_keys(tree)
+    first = {}
+    shared = {}
+    for node in postorder(tree):
+        if node.get_node_type() != 'relation':
+            if keys[id(node)] in first:
+                shared[id(node)] = first[keys[id(node)]]
+            else:
+                first[keys[id(node)]] = node
+    return shared
+
+
+# ------------------------ Logical optimizer ---------------------------------
+# Rewrite a checked tree into an equivalent one that is cheaper to evaluate:
+# stacked selects are merged, selections are pushed towards the relations,
+# projections narrow the inputs of joins and products, and redundant
+# rename/project chains are removed. The tree passed in is not modified, so
+# it can still be displayed as written. Like the other passes, the rewrites
+# walk the tree with explicit stacks, so trees of any depth are optimized.
+
+SELECT_CONDITIONS_LIMIT = 256   # conditions of one merged select node
+
+def optimize_tree(tree, db=None):
+    continue_temp_names(tree)
+    tree = copy_tree(tree)
+    tree = push_selections(tree)
+    if db is not None:
+        tree = reorder_joins(tree, get_table_stats(db))
+        tree = remove_redundant(tree)
+    tree = push_projections(tree)
+    tree = remove_redundant(tree)
+    return tree
+
+
+def tree_depth(tree):
+    depth = 0
+    stack = [(tree, 1)] if tree is not None else []
+    while stack:
+        node, level = stack.pop()
+        depth = max(depth, level)
+        for child in [node.get_left_child(), node.get_right_child()]:
+            if child is not None:
+                stack.append((child, level + 1))
+    return depth
+
+
+def copy_tree(tree):
+    copies = {id(None): None}
+    for old in postorder(tree):
+        node = Node(old.get_node_type(), copies[id(old.get_left_child())],
+                    copies[id(old.get_right_child())])
+        node.set_columns(old.get_columns())
+        node.set_conditions(old.get_conditions())
+        node.set_relation_name(old.get_relation_name())
+        node.set_attributes(old.get_attributes())
+        node.set_domains(old.get_domains())
+        node.set_join_columns(old.get_join_columns())
+        node.distinct = old.distinct
+        copies[id(old)] = node
+    return copies[id(tree)]
+
+
+def condition_columns(condition):
+    cols = []
+    if condition[0] == 'col':
+        cols.append(condition[1])
+    if condition[3] == 'col':
+        cols.append(condition[4])
+    return cols
+
+
+def rename_condition(condition, mapping):
+    condition = list(condition)
+    if condition[0] == 'col':
+        condition[1] = mapping[condition[1]]
+    if condition[3] == 'col':
+        condition[4] = mapping[condition[4]]
+    return condition
+
+
+def has_aggregates(columns):
+    return any('(' in col for col in columns)
+
+
+def is_qualified(attrs):
+    return attrs is None or any('.' in attr for attr in attrs)
+
+
+# select[conditions](child), with every condition once. SQLite limits the
+# depth of the 'and' chain of a where clause, so conditions beyond
+# SELECT_CONDITIONS_LIMIT go to further selects stacked on the first.
+def make_select(conditions, child):
+    unique = []
+    seen = set()
+    for condition in conditions:
+        if tuple(condition) not in seen:
+            seen.add(tuple(condition))
+            unique.append(condition)
+    for start in range(0, len(unique), SELECT_CONDITIONS_LIMIT):
+        n = Node("select", child, None)
+        n.set_conditions(unique[start:start + SELECT_CONDITIONS_LIMIT])
+        n.set_relation_name(next_temp_name())
+        n.set_attributes(child.get_attributes())
+        n.set_domains(child.get_domains())
+        child = n
+    return child
+
+
+# projection that only narrows child to the given attributes
+def make_narrowing_project(attrs, child):
+    n = Node("project", child, None)
+    n.set_columns(attrs)
+    n.set_relation_name(next_temp_name())
+    n.set_attributes(attrs)
+    if child.get_domains() is not None:
+        doms = child.get_domains()
+        n.set_domains([doms[child.get_attributes().index(a)] for a in attrs])
+    n.distinct = False
+    return n
+
+
+# children of every node are replaced by their rewritten trees, in postorder
+def push_selections(tree):
+    pushed = {id(None): None}
+    for node in postorder(tree):
+        if node.get_node_type() != 'relation':
+            node.set_left_child(pushed[id(node.get_left_child())])
+            node.set_right_child(pushed[id(node.get_right_child())])
+        if node.get_node_type() == 'select':
+            pushed[id(node)] = push_select(node.get_conditions(), node.get_left_child())
+        else:
+            pushed[id(node)] = node
+    return pushed[id(tree)]
+
+
+# return a tree equivalent to select[conditions](child) with the conditions
+# moved as far down as they can go. The stack holds the conditions still to
+# push into a subtree, with the node and side the result is attached to, and
+# the join and times nodes to put their remaining conditions above once
+# both their inputs are done.
+def push_select(conditions, child):
+    result = {}
+    stack = [('push', conditions, child, result, 'tree')]
+    while stack:
+        step, conditions, child, parent, side = stack.pop()
+        if step == 'above':
+            attach(parent, side, make_select(conditions, child))
+            continue
+        while child.get_node_type() == 'select':
+            conditions = child.get_conditions() + conditions
+            child = child.get_left_child()
+        for item in push_select_step(conditions, child, parent, side):
+            stack.append(item)
+    return result['tree']
+
+
+# the steps pushing conditions into child, attached to parent at side, in
+# reverse order of execution
+def push_select_step(conditions, child, parent, side):
+    ntype = child.get_node_type()
+
+    if ntype in ['join', 'times']:
+        lattrs = child.get_left_child().get_attributes()
+        rattrs = child.get_right_child().get_attributes()
+        left, right, rest = [], [], []
+        for condition in conditions:
+            cols = condition_columns(condition)
+            if all(col in lattrs for col in cols):
+                left.append(condition)
+            elif all(col in rattrs for col in cols):
+                right.append(condition)
+            else:
+                rest.append(condition)
+        steps = [('above', rest, child, parent, side)]
+        if right:
+            steps.append(('push', right, child.get_right_child(), child, 'right_child'))
+        if left:
+            steps.append(('push', left, child.get_left_child(), child, 'left_child'))
+        return steps
+
+    if ntype == 'union':
+        rattrs = child.get_right_child().get_attributes()
+        if not is_qualified(rattrs):
+            mapping = dict(zip(child.get_attributes(), rattrs))
+            attach(parent, side, child)
+            return [('push', [rename_condition(c, mapping) for c in conditions],
+                     child.get_right_child(), child, 'right_child'),
+                    ('push', conditions, child.get_left_child(), child, 'left_child')]
+
+    if ntype in ['intersect', 'minus'] or \
+            (ntype == 'project' and not has_aggregates(child.get_columns())):
+        attach(parent, side, child)
+        return [('push', conditions, child.get_left_child(), child, 'left_child')]
+
+    if ntype == 'rename':
+        old_attrs = child.get_left_child().get_attributes()
+        if not is_qualified(old_attrs):
+            mapping = dict(zip(child.get_attributes(), old_attrs))
+            attach(parent, side, child)
+            return [('push', [rename_condition(c, mapping) for c in conditions],
+                     child.get_left_child(), child, 'left_child')]
+
+    return [('above', conditions, child, parent, side)]
+
+
+# set the side ('left_child', 'right_child') of parent to node; parent may
+# also be a dict collecting a result
+def attach(parent, side, node):
+    if isinstance(parent, dict):
+        parent[side] = node
+    elif side == 'left_child':
+        parent.set_left_child(node)
     else:
-        lquery = generateSQL(tree.get_left_child(), db)
-        if tree.get_left_child().get_node_type() == "union":
-            lquery = "("+lquery+")"
-        rquery = generateSQL(tree.get_right_child(), db)
-        if tree.get_right_child().get_node_type() == "union":
-            rquery = "("+rquery+")"
-        query = "select * from ("+lquery+") "+tree.get_left_child().get_relation_name() + \
-                " where ("
-        for attr in tree.get_attributes():
-            query += attr+", "
-        query = query[:-2] + ") not in "
-        query += "(select * from ("+rquery+") " + \
-            tree.get_right_child().get_relation_name()
-        query += ")"
-        return query
+        parent.set_right_child(node)
+
+
+# nodes are visited top down, each after its parent has narrowed it
+def push_projections(tree):
+    stack = [tree] if tree is not None else []
+    while stack:
+        node = stack.pop()
+        if node.get_node_type() == 'relation':
+            continue
+        if node.get_node_type() == 'project' and not has_aggregates(node.get_columns()):
+            child = node.get_left_child()
+            needed = set(node.get_columns())
+            if child.get_node_type() == 'select' and \
+                    child.get_left_child().get_node_type() in ['join', 'times']:
+                for condition in child.get_conditions():
+                    needed.update(condition_columns(condition))
+                child.set_left_child(narrow(child.get_left_child(), needed))
+                child.set_attributes(child.get_left_child().get_attributes())
+                child.set_domains(child.get_left_child().get_domains())
+            elif child.get_node_type() in ['join', 'times']:
+                narrow_inputs(child, needed)
+        for child in [node.get_right_child(), node.get_left_child()]:
+            if child is not None:
+                stack.append(child)
+    return tree
+
+
+# narrow tree to the attributes in needed, keeping its column order
+def narrow(tree, needed):
+    attrs = tree.get_attributes()
+    if is_qualified(attrs):
+        return tree
+    keep = [attr for attr in attrs if attr in needed]
+    # an input with no needed columns still decides whether rows survive
+    if len(keep) == len(attrs) or len(keep) == 0:
+        return tree
+    return make_narrowing_project(keep, tree)
+
+
+# narrow the inputs of a join or times node to the attributes in needed
+# (plus the join columns) and recompute the node's schema
+def narrow_inputs(tree, needed):
+    if is_qualified(tree.get_attributes()):
+        return
+    needed = needed | set(tree.get_join_columns())
+    left = narrow(tree.get_left_child(), needed)
+    right = narrow(tree.get_right_child(), needed)
+    tree.set_left_child(left)
+    tree.set_right_child(right)
+
+    attrs = left.get_attributes()[:]
+    doms = None
+    if left.get_domains() is not None and right.get_domains() is not None:
+        doms = left.get_domains()[:]
+    for i, attr in enumerate(right.get_attributes()):
+        if tree.get_node_type() == 'times' or attr not in left.get_attributes():
+            attrs.append(attr)
+            if doms is not None:
+                doms.append(right.get_domains()[i])
+    tree.set_attributes(attrs)
+    tree.set_domains(doms)
+
+
+def remove_redundant(tree):
+    kept = {id(None): None}
+    for node in postorder(tree):
+        if node.get_node_type() == 'relation':
+            kept[id(node)] = node
+            continue
+        node.set_left_child(kept[id(node.get_left_child())])
+        node.set_right_child(kept[id(node.get_right_child())])
+        kept[id(node)] = remove_redundant_node(node)
+    return kept[id(tree)]
+
+
+# the node that replaces tree, whose children are already rewritten
+def remove_redundant_node(tree):
+    child = tree.get_left_child()
+
+    if tree.get_node_type() == 'rename':
+        # rename[a](rename[b](x)) = rename[a](x)
+        while child.get_node_type() == 'rename':
+            child = child.get_left_child()
+        tree.set_left_child(child)
+        # a rename to the same names is kept above relations, whose name
+        # is also their alias in the generated SQL
+        if child.get_attributes() == tree.get_attributes() and \
+                child.get_node_type() != 'relation':
+            return child
+
+    if tree.get_node_type() == 'project' and not has_aggregates(tree.get_columns()):
+        # project[a](project[b](x)) = project[a](x)
+        while child.get_node_type() == 'project' and \
+                not has_aggregates(child.get_columns()):
+            child = child.get_left_child()
+        tree.set_left_child(child)
+        # projecting a duplicate free input onto all of its columns
+        if child.get_attributes() == tree.get_columns() and (
+                child.get_node_type() in ['join', 'union', 'intersect', 'minus'] or
+                (child.get_node_type() == 'project' and child.distinct)):
+            return child
+
+    return tree
+
+
+# ------------------------ Join reordering ----------------------------------
+# Chains of natural joins (and products without clashing column names) are
+# reordered using row counts and distinct value counts of the relations.
+# Statistics come from sqlite_stat1 once the database has been ANALYZEd
+# (the "analyze;" command) and otherwise from count(*) and unique indexes.
+# Chains of up to DP_JOIN_LIMIT inputs are planned exhaustively with
+# dynamic programming, longer ones greedily. Greedy planning takes time cubic
+# in the number of inputs, so chains of more than GREEDY_JOIN_LIMIT inputs are
+# kept as written.
+
+DP_JOIN_LIMIT = 8
+GREEDY_JOIN_LIMIT = 32
+DEFAULT_SELECTIVITY = 0.1   # fraction of rows kept by an unknown predicate
+
+_stats_cache = {}   # abs path -> (data_version, {RNAME: (rows, {ATTR: ndv})})
+
+
+def get_table_stats(db):
+    path = os.path.abspath(db.dbfile)
+    version = get_data_version(db.dbfile)
+    entry = _stats_cache.get(path)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    c = db.conn.cursor()
+    stat1 = []
+    c.execute("select count(*) from sqlite_schema where name='sqlite_stat1'")
+    if c.fetchone()[0] > 0:
+        c.execute("select tbl, idx, stat from sqlite_stat1")
+        stat1 = c.fetchall()
+
+    stats = {}
+    for name in get_schema_catalog(db.dbfile, db.conn):
+        rows = None
+        ndv = {}
+        for tbl, idx, stat in stat1:
+            if tbl != name:
+                continue
+            vals = [int(v) for v in stat.split() if v.isdigit()]
+            rows = vals[0]
+            if idx is not None and len(vals) > 1:
+                c.execute("select name from pragma_index_info(?) order by seqno", (idx,))
+                cols = c.fetchall()
+                if cols:
+                    ndv[cols[0][0].upper()] = max(rows / max(vals[1], 1), 1)
+        if rows is None:
+            c.execute('select count(*) from "' + name + '"')
+            rows = c.fetchone()[0]
+        c.execute("select name from pragma_index_list(?) where \"unique\"", (name,))
+        for idx in c.fetchall():
+            c.execute("select name from pragma_index_info(?)", (idx[0],))
+            cols = c.fetchall()
+            if len(cols) == 1 and cols[0][0] is not None:
+                ndv[cols[0][0].upper()] = max(rows, 1)
+        stats[name.upper()] = (rows, ndv)
+    c.close()
+
+    _stats_cache[path] = (version, stats)
+    return stats
+
+
+# estimated (rows, {attr: distinct values}) of the result of tree
+def estimate(tree, stats):
+    return estimate_all(tree, stats)[id(tree)]
+
+
+# estimates of every node of tree, by id(node)
+def estimate_all(tree, stats):
+    estimates = {}
+    for node in postorder(tree):
+        estimates[id(node)] = estimate_node(node, stats, estimates)
+    return estimates
+
+
+# estimate of one node from those of its children in estimates
+def estimate_node(tree, stats, estimates):
+    ntype = tree.get_node_type()
+    if ntype == 'relation':
+        rows, ndv = stats.get(tree.get_relation_name(), (1000, {}))
+        return rows, ndv
+
+    lrows, lndv = estimates[id(tree.get_left_child())]
+    if ntype == 'select':
+        rows = lrows
+        for condition in tree.get_conditions():
+            if condition[2] == '=' and condition[3] != 'col' and condition[0] == 'col':
+                rows = rows / ndv_of(lrows, lndv, condition[1])
+            else:
+                rows = rows * DEFAULT_SELECTIVITY
+        return cap_ndv(max(rows, 1), lndv)
+    if ntype == 'project':
+        return lrows, lndv
+    if ntype == 'rename':
+        old_attrs = tree.get_left_child().get_attributes()
+        return lrows, {new: lndv[old] for new, old in zip(tree.get_attributes(), old_attrs)
+                       if old in lndv}
+
+    rrows, rndv = estimates[id(tree.get_right_child())]
+    if ntype in ['join', 'times']:
+        common = tree.get_join_columns() if ntype == 'join' else []
+        return join_estimate(lrows, lndv, rrows, rndv, common)
+    if ntype == 'union':
+        return lrows + rrows, lndv
+    if ntype == 'intersect':
+        return cap_ndv(min(lrows, rrows), lndv)
+    return lrows, lndv
+
+
+def ndv_of(rows, ndv, attr):
+    return ndv.get(attr, max(rows * DEFAULT_SELECTIVITY, 1))
+
+
+def cap_ndv(rows, ndv):
+    return rows, {attr: min(n, rows) for attr, n in ndv.items()}
+
+
+def join_estimate(lrows, lndv, rrows, rndv, common):
+    rows = lrows * rrows
+    for col in common:
+        rows = rows / max(ndv_of(lrows, lndv, col), ndv_of(rrows, rndv, col))
+    ndv = dict(rndv)
+    ndv.update(lndv)
+    return cap_ndv(max(rows, 1), ndv)
+
+
+# join chains are planned in postorder, where the children of the root of a
+# chain are its inputs: every input is reordered before its chain. The join
+# nodes inside a chain kept as written are not taken for chains of their own.
+def reorder_joins(tree, stats):
+    chains = {}
+    written = set()
+    order = []
+    stack = [tree] if tree is not None else []
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        if node.get_node_type() == 'relation':
+            continue
+        children = [node.get_left_child(), node.get_right_child()]
+        if node.get_node_type() == 'join' and id(node) not in written and \
+                not is_qualified(node.get_attributes()):
+            inputs = collect_join_inputs(node)
+            if 3 <= len(inputs) <= GREEDY_JOIN_LIMIT:
+                chains[id(node)] = inputs
+                children = inputs
+            elif len(inputs) > GREEDY_JOIN_LIMIT:
+                ends = set(id(i) for i in inputs)
+                written.update(id(n) for n in postorder(node, lambda n: id(n) not in ends))
+        stack.extend(child for child in children if child is not None)
+    order.reverse()
+
+    planned = {id(None): None}
+    for node in order:
+        if id(node) in chains:
+            planned[id(node)] = plan_joins(
+                node, [planned[id(i)] for i in chains[id(node)]], stats)
+            continue
+        if node.get_node_type() != 'relation':
+            node.set_left_child(planned[id(node.get_left_child())])
+            node.set_right_child(planned[id(node.get_right_child())])
+        planned[id(node)] = node
+    return planned[id(tree)]
+
+
+# inputs of the chain of join/times nodes rooted at tree, left to right
+def collect_join_inputs(tree):
+    inputs = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node.get_node_type() in ['join', 'times'] and \
+                not is_qualified(node.get_attributes()):
+            stack.append(node.get_right_child())
+            stack.append(node.get_left_child())
+        else:
+            inputs.append(node)
+    return inputs
+
+
+# replace the join chain rooted at tree by the cheapest order of its inputs
+def plan_joins(tree, inputs, stats):
+    ests = []
+    for i in inputs:
+        if is_qualified(i.get_attributes()):
+            return tree
+        rows, ndv = estimate(i, stats)
+        ests.append((rows, ndv, i.get_attributes()))
+
+    original = plan_cost(shape_of(tree, inputs), ests)
+    if len(inputs) <= DP_JOIN_LIMIT:
+        cost, plan = dp_join_order(ests)
+    else:
+        cost, plan = greedy_join_order(ests)
+    if cost >= original[0]:
+        return tree
+
+    node = build_join(plan, inputs)
+    if node.get_attributes() != tree.get_attributes():
+        # the order of the output columns follows the join order
+        node = make_narrowing_project(tree.get_attributes(), node)
+    return node
+
+
+# the plan (nested pairs of input positions) of the chain as written
+def shape_of(tree, inputs):
+    positions = {id(i): n for n, i in reversed(list(enumerate(inputs)))}
+    shapes = {}
+    for node in postorder(tree, lambda node: id(node) not in positions):
+        if id(node) in positions:
+            shapes[id(node)] = positions[id(node)]
+        else:
+            shapes[id(node)] = (shapes[id(node.get_left_child())],
+                                shapes[id(node.get_right_child())])
+    return shapes[id(tree)]
+
+
+# the values of the leaves and inner pairs of a plan, combined in postorder:
+# leaf(position) and pair(left value, right value)
+def fold_plan(plan, leaf, pair):
+    values = []
+    stack = [(plan, False)]
+    while stack:
+        part, children_done = stack.pop()
+        if isinstance(part, int):
+            values.append(leaf(part))
+        elif children_done:
+            right = values.pop()
+            values.append(pair(values.pop(), right))
+        else:
+            stack.append((part, True))
+            stack.append((part[1], False))
+            stack.append((part[0], False))
+    return values[0]
+
+
+def combine(left, right):
+    lrows, lndv, lattrs = left
+    rrows, rndv, rattrs = right
+    common = [attr for attr in lattrs if attr in rattrs]
+    rows, ndv = join_estimate(lrows, lndv, rrows, rndv, common)
+    return rows, ndv, lattrs + [attr for attr in rattrs if attr not in lattrs]
+
+
+# (cost, estimate) of a plan; cost is the sum of the intermediate row counts
+def plan_cost(plan, ests):
+    return fold_plan(plan, lambda i: (0, ests[i]), join_cost)
+
+
+def join_cost(left, right):
+    lcost, lest = left
+    rcost, rest = right
+    est = combine(lest, rest)
+    return lcost + rcost + est[0], est
+
+
+def dp_join_order(ests):
+    n = len(ests)
+    best = {}
+    for i in range(n):
+        best[1 << i] = (0, ests[i], i)
+    for mask in sorted(range(1, 1 << n), key=lambda m: bin(m).count('1')):
+        if mask in best:
+            continue
+        sub = (mask - 1) & mask
+        while sub > 0:
+            other = mask ^ sub
+            if sub < other:
+                lcost, lest, lplan = best[sub]
+                rcost, rest, rplan = best[other]
+                est = combine(lest, rest)
+                cost = lcost + rcost + est[0]
+                if mask not in best or cost < best[mask][0]:
+                    best[mask] = (cost, est, (lplan, rplan))
+            sub = (sub - 1) & mask
+    cost, _, plan = best[(1 << n) - 1]
+    return cost, plan
+
+
+def greedy_join_order(ests):
+    parts = [(0, est, i) for i, est in enumerate(ests)]
+    while len(parts) > 1:
+        choice = None
+        for a in range(len(parts)):
+            for b in range(a + 1, len(parts)):
+                est = combine(parts[a][1], parts[b][1])
+                cost = parts[a][0] + parts[b][0] + est[0]
+                if choice is None or cost < choice[0]:
+                    choice = (cost, est, a, b)
+        cost, est, a, b = choice
+        merged = (cost, est, (parts[a][2], parts[b][2]))
+        parts = [p for i, p in enumerate(parts) if i not in (a, b)] + [merged]
+    return parts[0][0], parts[0][2]
+
+
+def build_join(plan, inputs):
+    return fold_plan(plan, lambda i: inputs[i], join_node)
+
+
+def join_node(left, right):
+    lattrs = left.get_attributes()
+    rattrs = right.get_attributes()
+    n = Node("join", left, right)
+    n.set_relation_name(next_temp_name())
+    n.set_join_columns([attr for attr in lattrs if attr in rattrs])
+    n.set_attributes(lattrs + [attr for attr in rattrs if attr not in lattrs])
+    if left.get_domains() is not None and right.get_domains() is not None:
+        n.set_domains(left.get_domains() +
+                      [dom for attr, dom in zip(rattrs, right.get_domains()) if attr not in lattrs])
+    return n
+
+
+# ------------------------ Index advisor -----------------------------------
+# The columns compared with constants in select conditions and the join
+# columns are traced back to the base relation columns they come from; the
+# ones that are not the leading column of any index are reported, and can
+# be indexed before the query runs.
+
+ADVISED_OPERATORS = ['=', '<', '>', '<=', '>=']
+
+
+# (RNAME, column) the column attr of tree is read from, or None when it is
+# computed or comes from more than one relation
+def base_column(tree, attr):
+    while True:
+        ntype = tree.get_node_type()
+        if ntype == 'relation':
+            return (tree.get_relation_name(), attr)
+        if ntype in ['select', 'project']:
+            if '(' in attr:
+                return None
+            tree = tree.get_left_child()
+        elif ntype == 'rename':
+            i = tree.get_attributes().index(attr)
+            tree = tree.get_left_child()
+            attr = tree.get_attributes()[i]
+        elif ntype in ['join', 'times'] and '.' not in attr:
+            inputs = [child for child in [tree.get_left_child(), tree.get_right_child()]
+                      if attr in child.get_attributes()]
+            if len(inputs) == 0:
+                return None
+            tree = inputs[0]
+        else:
+            return None
+
+
+# advice of the nodes of tree in preorder; the first reason for a column is kept
+def collect_advice(tree, advice):
+    stack = [tree] if tree is not None else []
+    while stack:
+        node = stack.pop()
+        if node.get_node_type() == 'relation':
+            continue
+        collect_node_advice(node, advice)
+        for child in [node.get_right_child(), node.get_left_child()]:
+            if child is not None:
+                stack.append(child)
+
+
+def collect_node_advice(tree, advice):
+    if tree.get_node_type() == 'select':
+        for condition in tree.get_conditions():
+            if condition[2] not in ADVISED_OPERATORS:
+                continue
+            if condition[0] == 'col' and condition[3] != 'col':
+                attr = condition[1]
+            elif condition[3] == 'col' and condition[0] != 'col':
+                attr = condition[4]
+            else:
+                continue
+            column = base_column(tree.get_left_child(), attr)
+            if column is not None:
+                advice.setdefault(column, "select " + str(condition[1]) +
+                                  condition[2] + str(condition[4]))
+    if tree.get_node_type() == 'join':
+        for col in tree.get_join_columns():
+            for child in [tree.get_left_child(), tree.get_right_child()]:
+                column = base_column(child, col)
+                if column is not None:
+                    advice.setdefault(column, "join on " + col)
+
+
+# leading columns of the indexes of each relation, including rowid aliases
+def get_indexed_columns(db):
+    indexed = {}
+    c = db.conn.cursor()
+    for name, records in get_schema_catalog(db.dbfile, db.conn).items():
+        cols = set()
+        pk = [record for record in records if record[2] > 0]
+        if len(pk) == 1 and pk[0][1].upper() == 'INTEGER':
+            cols.add(pk[0][0].upper())
+        c.execute("select name from pragma_index_list(?)", (name,))
+        for idx in c.fetchall():
+            c.execute("select name from pragma_index_info(?) where seqno=0", (idx[0],))
+            first = c.fetchone()
+            if first is not None and first[0] is not None:
+                cols.add(first[0].upper())
+        indexed[name.upper()] = cols
+    c.close()
+    return indexed
+
+
+# list of {'relation', 'column', 'reason'} for the base columns tree filters
+# or joins on that no index starts with
+def advise_indexes(tree, db):
+    advice = {}
+    collect_advice(tree, advice)
+    indexed = get_indexed_columns(db)
+    missing = []
+    for (rname, col), reason in advice.items():
+        if col not in indexed.get(rname, set()):
+            missing.append({'relation': rname, 'column': col, 'reason': reason})
+    return missing
+
+
+def display_index_advice(advice):
+    if len(advice) == 0:
+        print("\nIndex advice: no missing indexes")
+        return
+    print("\nIndex advice: missing indexes")
+    for item in advice:
+        print("  " + item['relation'] + "(" + item['column'] + ")	# " + item['reason'])
+
+
+# create the advised indexes, largest tables last, while their estimated size
+# fits in budget bytes; returns the names of the indexes created
+def create_indexes(advice, db, budget):
+    stats = get_table_stats(db)
+    tables = {name.upper(): name for name in get_schema_catalog(db.dbfile, db.conn)}
+    created = []
+    for item in sorted(advice, key=lambda item: stats.get(item['relation'], (0, {}))[0]):
+        table = tables[item['relation']]
+        c = db.conn.cursor()
+        c.execute('select count(*), sum(length("' + item['column'] + '")) from "' + table + '"')
+        rows, length = c.fetchone()
+        c.close()
+        size = (length or 0) + rows * 16     # key bytes plus rowid and overhead
+        if size > budget:
+            continue
+        name = ("ra_idx_" + table + "_" + item['column']).lower()
+        db.conn.execute('create index if not exists "' + name + '" on "' + table +
+                        '"("' + item['column'] + '")')
+        created.append(name)
+        budget -= size
+    return created
+
+
+# ------------------------ Columnar execution engine ------------------------
+# An alternative to generating SQL: the tree is evaluated in process over
+# batches of NumPy column arrays, with hash joins and hash-based set
+# operations. Base relations are loaded once per data version and kept in
+# memory. It needs numpy and is chosen per query with "backend columnar;".
+
+COLUMNAR_CACHE_SIZE = 32     # base relations kept in memory
+_columnar_cache = OrderedDict()
+
+COMPARISONS = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+# numpy is imported by the first columnar query, not at startup
+np = None
+
+
+def numpy_available():
+    return importlib.util.find_spec('numpy') is not None
+
+
+def load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+class ColumnBatch():
+
+    def __init__(self, names, columns, affinities):
+        self.names = names
+        self.columns = columns
+        self.affinities = affinities	# SQLite column affinity, None for expressions
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def column(self, name):
+        return self.columns[self.names.index(name)]
+
+    def affinity(self, name):
+        return self.affinities[self.names.index(name)]
+
+    def renamed(self, names):
+        return ColumnBatch(names, self.columns, self.affinities)
+
+    def take(self, idx):
+        return ColumnBatch(self.names, [col[idx] for col in self.columns], self.affinities)
+
+    def rows(self):
+        return list(zip(*[col.tolist() for col in self.columns]))
+
+
+# int64 or float64 array for columns of only ints or only floats, an object
+# array otherwise (NULLs, text, mixed numbers)
+def to_array(values):
+    if len(values) > 0 and all(type(v) is int for v in values):
+        try:
+            return np.array(values, dtype=np.int64)
+        except OverflowError:
+            pass
+    elif len(values) > 0 and all(type(v) is float for v in values):
+        return np.array(values, dtype=np.float64)
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def is_numeric(array):
+    return array.dtype.kind in 'if'
+
+
+def concat_arrays(a, b):
+    if a.dtype != b.dtype:
+        a = a.astype(object)
+        b = b.astype(object)
+    return np.concatenate([a, b])
+
+
+# affinity SQLite gives a column of the declared type
+def column_affinity(decltype):
+    decltype = decltype.upper()
+    if 'INT' in decltype:
+        return 'INTEGER'
+    if 'CHAR' in decltype or 'CLOB' in decltype or 'TEXT' in decltype:
+        return 'TEXT'
+    if 'BLOB' in decltype or decltype == '':
+        return None
+    if 'REAL' in decltype or 'FLOA' in decltype or 'DOUB' in decltype:
+        return 'REAL'
+    return 'NUMERIC'
+
+
+def load_relation(db, rname):
+    key = (os.path.abspath(db.dbfile), rname)
+    version = get_data_version(db.dbfile)
+    entry = _columnar_cache.get(key)
+    if entry is not None and entry[0] == version:
+        _columnar_cache.move_to_end(key)
+        return entry[1]
+    c = db.conn.cursor()
+    c.execute("select * from " + rname)
+    records = c.fetchall()
+    c.close()
+    attrs = db.getAttributes(rname)
+    columns = [to_array([record[i] for record in records]) for i in range(len(attrs))]
+    for name, decls in get_schema_catalog(db.dbfile, db.conn).items():
+        if name.upper() == rname:
+            affinities = [column_affinity(decl[1]) for decl in decls]
+    batch = ColumnBatch(attrs, columns, affinities)
+    _columnar_cache[key] = (version, batch)
+    _columnar_cache.move_to_end(key)
+    while len(_columnar_cache) > COLUMNAR_CACHE_SIZE:
+        _columnar_cache.popitem(last=False)
+    return batch
+
+
+# group number of every row of columns, and the first row of every group
+def factorize(columns, n):
+    if len(columns) == 1 and is_numeric(columns[0]):
+        _, first, groups = np.unique(columns[0], return_index=True, return_inverse=True)
+        return groups.reshape(-1), first
+    seen = {}
+    groups = np.empty(n, dtype=np.int64)
+    first = []
+    for i, key in enumerate(zip(*[col.tolist() for col in columns])):
+        g = seen.get(key)
+        if g is None:
+            g = seen[key] = len(first)
+            first.append(i)
+        groups[i] = g
+    return groups, np.array(first, dtype=np.int64)
+
+
+def distinct_rows(batch):
+    _, first = factorize(batch.columns, len(batch))
+    return batch.take(np.sort(first))
+
+
+# SQLite comparison: NULL never matches and numbers sort before text
+def sql_compare(op, a, b):
+    if a is None or b is None:
+        return False
+    anum = isinstance(a, (int, float))
+    if anum == isinstance(b, (int, float)):
+        return COMPARISONS[op](a, b)
+    return COMPARISONS[op](0 if anum else 1, 1 if anum else 0)
+
+
+# LIKE pattern as a case insensitive regular expression
+def like_regex(pattern):
+    regex = ''
+    for ch in str(pattern):
+        if ch == '%':
+            regex += '.*'
+        elif ch == '_':
+            regex += '.'
+        else:
+            regex += re.escape(ch)
+    return re.compile(regex, re.IGNORECASE | re.DOTALL)
+
+
+# text that reads as a number becomes that number, as under numeric affinity
+def to_numeric(value):
+    if isinstance(value, str):
+        text = value.strip()
+        if re.fullmatch(r'[+-]?\d+', text):
+            return int(text)
+        if re.fullmatch(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?', text):
+            return float(text)
+    return value
+
+
+def to_text(value):
+    if isinstance(value, (int, float)):
+        return str(value)
+    return value
+
+
+def operand(batch, otype, value, n):
+    if otype == 'col':
+        return batch.column(value), batch.affinity(value)
+    return np.full(n, value, dtype=object if otype == 'str' else np.float64), None
+
+
+# convert the operands of a comparison the way SQLite does: a numeric
+# affinity side makes the other side numeric, otherwise a text affinity side
+# makes an operand without affinity text
+def apply_affinity(values, affinity, other):
+    if other in ['INTEGER', 'REAL', 'NUMERIC'] and affinity not in ['INTEGER', 'REAL', 'NUMERIC']:
+        if values.dtype.kind == 'O':
+            return to_array([to_numeric(v) for v in values.tolist()])
+    elif other == 'TEXT' and affinity is None:
+        return to_array([to_text(v) for v in values.tolist()])
+    return values
+
+
+def condition_mask(batch, condition):
+    n = len(batch)
+    left, laff = operand(batch, condition[0], condition[1], n)
+    right, raff = operand(batch, condition[3], condition[4], n)
+    op = condition[2]
+    if op != 'LIKE':
+        left, right = apply_affinity(left, laff, raff), apply_affinity(right, raff, laff)
+    if op == 'LIKE':
+        if condition[3] == 'col':
+            return np.fromiter((a is not None and b is not None and
+                                like_regex(b).fullmatch(str(a)) is not None
+                                for a, b in zip(left.tolist(), right.tolist())),
+                               dtype=bool, count=n)
+        regex = like_regex(condition[4])
+        return np.fromiter((a is not None and regex.fullmatch(str(a)) is not None
+                            for a in left.tolist()), dtype=bool, count=n)
+    if is_numeric(left) and is_numeric(right):
+        return COMPARISONS[op](left, right)
+    return np.fromiter((sql_compare(op, a, b) for a, b in zip(left.tolist(), right.tolist())),
+                       dtype=bool, count=n)
+
+
+# SUM of SQLite: NULL for no values, integer when every value is an integer
+def sum_values(values):
+    total = None
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, str):
+            try:
+                v = float(v)
+            except ValueError:
+                v = 0.0
+        total = v if total is None else total + v
+    return total
+
+
+def aggregate(column, func, groups, ngroups):
+    if column is None:
+        return np.bincount(groups, minlength=ngroups).astype(np.int64)
+    if func == 'COUNT':
+        if is_numeric(column):
+            present = np.ones(len(column), dtype=np.int64)
+        else:
+            present = np.fromiter((v is not None for v in column.tolist()),
+                                  dtype=np.int64, count=len(column))
+        return np.bincount(groups, weights=present, minlength=ngroups).astype(np.int64)
+    if is_numeric(column) and len(column) > 0:
+        totals = np.zeros(ngroups, dtype=column.dtype)
+        np.add.at(totals, groups, column)
+        return totals
+    members = [[] for _ in range(ngroups)]
+    for g, v in zip(groups.tolist(), column.tolist()):
+        members[g].append(v)
+    return to_array([sum_values(values) for values in members])
+
+
+def project_batch(tree, batch):
+    columns = tree.get_columns()
+    keys = [col for col in columns if '(' not in col]
+    if len(keys) == len(columns):
+        result = ColumnBatch(tree.get_attributes(), [batch.column(col) for col in keys],
+                             [batch.affinity(col) for col in keys])
+        return distinct_rows(result) if tree.distinct else result
+    n = len(batch)
+    if keys:
+        groups, first = factorize([batch.column(col) for col in keys], n)
+    else:
+        groups, first = np.zeros(n, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    ngroups = len(first)
+    result = []
+    affinities = []
+    for col in columns:
+        affinities.append(None if '(' in col else batch.affinity(col))
+        if '(' not in col:
+            result.append(batch.column(col)[first])
+            continue
+        func, arg = col.split('(')
+        arg = arg.strip(')')
+        result.append(aggregate(None if arg == '*' else batch.column(arg),
+                                func.upper(), groups, ngroups))
+    return ColumnBatch(tree.get_attributes(), result, affinities)
+
+
+# matching (left row, right row) pairs of an equi-join; the hash table is
+# built on the smaller side and NULL keys never match
+def join_indices(lkeys, rkeys, nl, nr):
+    if nr > nl:
+        ridx, lidx = join_indices(rkeys, lkeys, nr, nl)
+        return lidx, ridx
+    table = {}
+    for j, key in enumerate(zip(*[col.tolist() for col in rkeys])):
+        if None not in key:
+            table.setdefault(key, []).append(j)
+    lidx = []
+    ridx = []
+    for i, key in enumerate(zip(*[col.tolist() for col in lkeys])):
+        matches = table.get(key)
+        if matches is not None:
+            lidx.extend([i] * len(matches))
+            ridx.extend(matches)
+    return np.array(lidx, dtype=np.int64), np.array(ridx, dtype=np.int64)
+
+
+def cross_indices(nl, nr):
+    return np.repeat(np.arange(nl), nr), np.tile(np.arange(nr), nl)
+
+
+def join_batch(tree, left, right, db):
+    jcols = tree.get_join_columns()
+    if jcols:
+        lidx, ridx = join_indices([left.column(col) for col in jcols],
+                                  [right.column(col) for col in jcols],
+                                  len(left), len(right))
+    else:
+        lidx, ridx = cross_indices(len(left), len(right))
+    columns = [col[lidx] for col in left.columns]
+    affinities = list(left.affinities)
+    for name, col, affinity in zip(right.names, right.columns, right.affinities):
+        if name not in jcols:
+            columns.append(col[ridx])
+            affinities.append(affinity)
+    result = ColumnBatch(tree.get_attributes(), columns, affinities)
+    if duplicate_free(tree.get_left_child(), db) and \
+            duplicate_free(tree.get_right_child(), db):
+        return result
+    return distinct_rows(result)
+
+
+def set_operation(ntype, left, right):
+    if ntype == 'union':
+        return distinct_rows(ColumnBatch(left.names, [concat_arrays(a, b) for a, b in
+                                                      zip(left.columns, right.columns)],
+                                         left.affinities))
+    left = distinct_rows(left)
+    members = set(right.rows())
+    keep = ntype == 'intersect'
+    mask = np.fromiter(((row in members) == keep for row in left.rows()),
+                       dtype=bool, count=len(left))
+    return left.take(mask)
+
+
+# evaluate a checked tree; the returned batch has the tree's attributes
+def evaluate_columnar(tree, db):
+    load_numpy()
+    keys = structure_keys(tree)
+    uses = {}
+    for node in postorder(tree):
+        for child in [node.get_left_child(), node.get_right_child()]:
+            if child is not None:
+                uses[keys[id(child)]] = uses.get(keys[id(child)], 0) + 1
+    # identical subtrees are evaluated once; a batch is dropped once every
+    # parent reading it has been evaluated
+    batches = {}
+    for node in postorder(tree):
+        key = keys[id(node)]
+        if key not in batches:
+            # a shared batch carries the attribute names of the subtree it
+            # was evaluated for
+            left, right = [batches[keys[id(child)]].renamed(child.get_attributes())
+                           if child is not None else None
+                           for child in [node.get_left_child(), node.get_right_child()]]
+            batches[key] = evaluate_node(node, db, left, right)
+        for child in [node.get_left_child(), node.get_right_child()]:
+            if child is not None:
+                uses[keys[id(child)]] -= 1
+                if uses[keys[id(child)]] == 0:
+                    del batches[keys[id(child)]]
+    return batches[keys[id(tree)]].renamed(tree.get_attributes())
+
+
+# one operation of evaluate_columnar on the batches of its children
+def evaluate_node(tree, db, left, right):
+    ntype = tree.get_node_type()
+    if ntype == 'relation':
+        return load_relation(db, tree.get_relation_name())
+    if ntype == 'select':
+        mask = np.ones(len(left), dtype=bool)
+        for condition in tree.get_conditions():
+            mask &= condition_mask(left, condition)
+        return left.take(mask).renamed(tree.get_attributes())
+    if ntype == 'project':
+        return project_batch(tree, left)
+    if ntype == 'rename':
+        return left.renamed(tree.get_attributes())
+    if ntype == 'join':
+        return join_batch(tree, left, right, db)
+    if ntype == 'times':
+        lidx, ridx = cross_indices(len(left), len(right))
+        return ColumnBatch(tree.get_attributes(), [col[lidx] for col in left.columns] +
+                           [col[ridx] for col in right.columns],
+                           left.affinities + right.affinities)
+    return set_operation(ntype, left, right).renamed(tree.get_attributes())
+
 
 # ------------------------ Dash app Functions -------------------------------
 # Convert the tree to a JSON object for visualization.
 
 
-def tree_to_json(node, db, node_counter=[0]):
+def tree_to_json(node, db, node_counter=[0], explain=False, time_nodes=False):
     if node is None:
         return None
 
+    # node ids are handed out in preorder, left subtree first
+    jsons = {}
+    stack = [(node, None, None)]
+    while stack:
+        current, parent_json, side = stack.pop()
+        jsons[id(current)] = node_to_json(current, node_counter, explain)
+        if parent_json is not None:
+            parent_json[side] = jsons[id(current)]
+        if current.get_right_child() is not None:
+            stack.append((current.get_right_child(), jsons[id(current)], 'right_child'))
+        if current.get_left_child() is not None:
+            stack.append((current.get_left_child(), jsons[id(current)], 'left_child'))
+
+    # common subexpressions, and the first subtree they share, carry the
+    # node_id of that subtree
+    shared = shared_subtrees(node)
+    for current in postorder(node, lambda current: id(current) not in shared):
+        if id(current) in shared:
+            first = jsons[id(shared[id(current)])]
+            first['shared'] = first['node_id']
+            jsons[id(current)]['shared'] = first['node_id']
+
+    # a node's plan is compared with the plans of its children; nodes are
+    # explained in the CTE form the CLI runs, which SQLite parses at any depth.
+    # Planning a subtree takes SQLite time growing faster than its size, so
+    # nodes above EXPLAIN_MAX_NODES nodes are not explained.
+    if explain:
+        estimates = estimate_all(node, get_table_stats(db))
+        keys = structure_keys(node)
+        for current, query, names in subtree_cte_sql(node, db, EXPLAIN_MAX_NODES):
+            if query is None:
+                jsons[id(current)]['plan'] = plan_from_lines(
+                    current, jsons[id(current)],
+                    ["no plan: more than %d nodes" % EXPLAIN_MAX_NODES],
+                    estimates[id(current)][0])
+                continue
+            jsons[id(current)]['plan'] = explain_node(
+                current, db, jsons[id(current)], time_nodes, query,
+                estimates[id(current)][0], keys[id(current)], names)
+    return jsons[id(node)]
+
+
+# JSON of one node, without its children and plan
+def node_to_json(node, node_counter, explain=False):
     relation_name = node.get_relation_name() if node.get_relation_name() else "UNKNOWN"
     node_id = f"node_{node_counter[0]}"
     node_counter[0] += 1
@@ -852,11 +2747,14 @@ def tree_to_json(node, db, node_counter=[0]):
         'node_id': node_id,
         'node_type': node.get_node_type(),
         'relation_name': relation_name,
-        'left_child': tree_to_json(node.get_left_child(), db, node_counter),
-        'right_child': tree_to_json(node.get_right_child(), db, node_counter),
+        'left_child': None,
+        'right_child': None,
         'attributes': node.get_attributes()
     }
 
+    if explain:
+        node_json['plan'] = None
+
     # Include columns, conditions, and join columns with full qualification if needed
     if node.get_node_type() == 'project':
         node_json['columns'] = node.get_columns()
@@ -871,54 +2769,291 @@ def tree_to_json(node, db, node_counter=[0]):
 
     return node_json
 
-# Generate a tree from the given query and perform semantic checks.
+# Generate a tree from the given query and perform semantic checks. With
+# explain, every node carries its query plan (explain_node).
 
 
-def generate_tree_from_query(query, db, node_counter=[0]):
+def generate_tree_from_query(query, db, node_counter=[0], explain=False, time_nodes=False):
     try:
-        tree = parser.parse(query)
+        with timed('parse'):
+            tree = parser.parse(query)
 
-        # Set temporary table names as done in the backend
-        set_temp_table_names(tree)
+        with timed('check'):
+            # Set temporary table names as done in the backend
+            set_temp_table_names(tree)
 
-        validation_msg = semantic_checks(tree, db)
+            validation_msg = semantic_checks(tree, db)
         if validation_msg != 'OK':
             return {'error': f"Semantic check failed: {validation_msg}"}
 
         # print("Generated Tree Structure:")
         # tree.print_tree(0)
 
-        json_tree = tree_to_json(tree, db, node_counter)
+        with timed('tree json'):
+            json_tree = tree_to_json(tree, db, node_counter, explain, time_nodes)
 
         return json_tree
     except Exception as e:
         return {'error': str(e)}
 
 
-# Recursively traverse the JSON tree to find the node with the given node_id.
-def get_node_by_id(json_tree, node_id):
-    if json_tree is None:
-        return None
-
-    if json_tree.get('node_id') == node_id:
-        return json_tree
-
-    left_result = get_node_by_id(json_tree.get('left_child'), node_id)
-    if left_result:
-        return left_result
+HEAVY_ROWS = 10000     # estimated input rows from which scans and sorts are heavy
+EXPLAIN_MAX_NODES = 256     # largest subtree explained (tree_to_json)
+PLAN_COUNTERS = {
+    'scans': lambda line: line.startswith('SCAN ') and not line.startswith('SCAN CONSTANT'),
+    'searches': lambda line: line.startswith('SEARCH '),
+    'temp_btrees': lambda line: 'USE TEMP B-TREE' in line,
+    'automatic_indexes': lambda line: 'AUTOMATIC' in line,
+}
 
-    right_result = get_node_by_id(json_tree.get('right_child'), node_id)
-    return right_result
 
+# Plans of recently explained SQL. When an edited query is submitted again,
+# only the nodes on the path from the edit to the root have new SQL, so only
+# they are explained; the plans of all other nodes are reused. Plans are
+# keyed by the structure key of the node (structure_keys), so renumbered TEMP
+# names still hit, and are dropped once the database has changed. The TEMP
+# names in a cached plan are numbered in postorder of the node's subtree.
+# Node times are not kept, as they change from run to run.
+PLAN_CACHE_SIZE = 2048
+_plan_cache = OrderedDict()     # (abs path, data_version, structure key) -> plan
+_plan_lock = threading.Lock()
+
+
+# EXPLAIN QUERY PLAN of the SQL of node: the plan lines, how many are full
+# scans, index searches, temp B-trees and automatic indexes, the estimated
+# rows of the cost model and, with time_nodes, the time to evaluate it.
+# 'heavy' lists why the node itself (not its children, whose plans are
+# already in node_json) is expensive. query, rows, structure_key and names,
+# when given, are the CTE SQL (generateCTESQL), estimated rows, structure key
+# and TEMP names of the interior nodes in postorder (subtree_cte_sql) of node.
+def explain_node(node, db, node_json, time_nodes=False, query=None, rows=None,
+                 structure_key=None, names=None):
+    if query is None:
+        query = generateCTESQL(node, db)
+    key = None
+    plan = None
+    if db.dbfile is not None:
+        if structure_key is None:
+            structure_key = structure_keys(node)[id(node)]
+        if names is None:
+            names = [other.get_relation_name() for other in postorder(node)
+                     if other.get_node_type() != 'relation']
+        names = {name: 'TEMP_' + str(i) for i, name in enumerate(names)}
+        key = (os.path.abspath(db.dbfile), get_data_version(db.dbfile), structure_key)
+        with _plan_lock:
+            cached = _plan_cache.get(key)
+            if cached is not None:
+                _plan_cache.move_to_end(key)
+        if cached is not None:
+            actual = {canonical: name for name, canonical in names.items()}
+            plan = dict(cached, summary=[rename_temps(line, actual)
+                                         for line in cached['summary']])
+    if plan is None:
+        c = db.conn.cursor()
+        try:
+            c.execute("explain query plan " + query)
+            lines = [row[3] for row in c.fetchall()]
+        except sqlite3.OperationalError as inst:
+            # a plan SQLite cannot make is shown instead of failing the tree
+            query = None
+            key = None
+            lines = ["no plan: " + str(inst)]
+        c.close()
+        if rows is None:
+            rows = estimate(node, get_table_stats(db))[0]
+        plan = plan_from_lines(node, node_json, lines, rows)
+        if key is not None:
+            with _plan_lock:
+                _plan_cache[key] = dict(plan, summary=[rename_temps(line, names)
+                                                       for line in lines])
+                _plan_cache.move_to_end(key)
+                while len(_plan_cache) > PLAN_CACHE_SIZE:
+                    _plan_cache.popitem(last=False)
+
+    if time_nodes and query is not None:
+        start = time.perf_counter()
+        db.conn.execute("select count(*) from (" + query + ")").fetchone()
+        plan['time_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return plan
+
+
+# plan of node from the lines of its EXPLAIN QUERY PLAN and its estimated rows
+def plan_from_lines(node, node_json, lines, rows):
+    plan = {'summary': lines,
+            'estimated_rows': int(round(rows))}
+    children = [node_json[side]['plan'] for side in ['left_child', 'right_child']
+                if node_json[side] is not None]
+    own = {}
+    for counter, matches in PLAN_COUNTERS.items():
+        plan[counter] = len([line for line in lines if matches(line)])
+        own[counter] = max(plan[counter] - sum(child[counter] for child in children), 0)
+    rows_in = max([child['estimated_rows'] for child in children] or [0])
+
+    heavy = []
+    ntype = node.get_node_type()
+    if ntype == 'times' or (ntype == 'join' and len(node.get_join_columns()) == 0):
+        heavy.append('cartesian product')
+    if rows_in >= HEAVY_ROWS:
+        if ntype == 'select' and plan['scans'] > 0 and plan['searches'] == 0:
+            heavy.append('full scan')
+        if own['temp_btrees'] > 0:
+            heavy.append('temp b-tree')
+        if own['automatic_indexes'] > 0:
+            heavy.append('automatic index')
+    plan['heavy'] = heavy
+    return plan
+
+
+# Traverse the JSON tree to find the node with the given node_id.
+def get_node_by_id(json_tree, node_id):
+    stack = [json_tree]
+    while stack:
+        json_node = stack.pop()
+        if json_node is None:
+            continue
+        if json_node.get('node_id') == node_id:
+            return json_node
+        stack.append(json_node.get('right_child'))
+        stack.append(json_node.get('left_child'))
+    return None
+
+
+# Flat table of the nodes of json_tree, for the app's sessions: 'nodes'
+# holds every node by node_id, with the node_ids of its children in
+# 'left_child' and 'right_child', the SQL of the node itself in 'sql',
+# reading its interior children by name (cte_query), its structure key in
+# 'key' and the depth of its subtree in 'depth'; 'root' is the node_id of the
+# root. A clicked node is then found without searching the tree, and its
+# query is put together from the table (index_cte_sql) without rebuilding its
+# subtree (get_node_info_from_db).
+def index_tree(json_tree, db):
+    nodes = {}
+    built = {id(None): None}    # id(JSON node) -> Node
+    order = []
+    stack = [(json_tree, False)]
+    while stack:
+        json_node, children_done = stack.pop()
+        if json_node is None:
+            continue
+        if not children_done:
+            stack.append((json_node, True))
+            stack.append((json_node.get('right_child'), False))
+            stack.append((json_node.get('left_child'), False))
+            continue
+        node = json_node_to_node(json_node, built[id(json_node.get('left_child'))],
+                                 built[id(json_node.get('right_child'))])
+        built[id(json_node)] = node
+        order.append((json_node, node))
+
+        entry = dict(json_node)
+        entry['depth'] = 1
+        for side in ['left_child', 'right_child']:
+            if json_node.get(side) is not None:
+                entry[side] = json_node[side]['node_id']
+                entry['depth'] = max(entry['depth'], 1 + nodes[entry[side]]['depth'])
+        entry['sql'] = cte_query(node, db)
+        nodes[json_node['node_id']] = entry
+
+    keys = structure_keys(built[id(json_tree)])
+    for json_node, node in order:
+        nodes[json_node['node_id']]['key'] = keys[id(node)]
+    return {'root': json_tree['node_id'], 'nodes': nodes}
+
+
+# CTE SQL of the subtree of node_id, put together from the SQL of its nodes
+# in the flat table index (index_tree) without rebuilding the subtree. It is
+# the SQL generateCTESQL gives for the subtree: common subexpressions read
+# the CTE of the first identical subtree, and the CTEs of deep subtrees are
+# evaluated on their own.
+def index_cte_sql(index, node_id):
+    nodes = index['nodes']
+    first = {}      # structure key -> node_id of its first subtree in postorder
+    shared = {}     # node_id -> node_id of the identical subtree it reads
+    order = []
+    stack = [(node_id, False)]
+    while stack:
+        current, children_done = stack.pop()
+        if current is None:
+            continue
+        entry = nodes[current]
+        if not children_done:
+            # every node before this subtree in postorder has been seen
+            if share_subexpressions and entry['node_type'] != 'relation' and \
+                    entry['key'] in first:
+                shared[current] = first[entry['key']]
+                order.append(current)
+                continue
+            stack.append((current, True))
+            stack.append((entry.get('right_child'), False))
+            stack.append((entry.get('left_child'), False))
+            continue
+        if entry['node_type'] != 'relation':
+            first[entry['key']] = current
+        order.append(current)
+
+    reused = set(shared.values())
+    deep = nodes[node_id]['depth'] > CTE_INLINE_DEPTH
+    ctes = []
+    for current in order[:-1]:
+        entry = nodes[current]
+        if current in shared:
+            ctes.append((entry['relation_name'],
+                         "select * from " + nodes[shared[current]]['relation_name'], False))
+        elif entry['node_type'] != 'relation':
+            ctes.append((entry['relation_name'], entry['sql'], deep or current in reused))
+    return with_ctes(ctes, nodes[node_id]['sql'])
+
+
+# The JSON node with node_id, in a JSON tree or the flat table of one
+def find_node(json_tree, node_id):
+    if 'nodes' in json_tree:
+        return json_tree['nodes'].get(node_id)
+    return get_node_by_id(json_tree, node_id)
+
+
+# Reconstruct the subtree of node_id from the flat table index (index_tree),
+# every node after its children.
+def index_to_node(index, node_id):
+    nodes = {None: None}
+    stack = [(node_id, False)]
+    while stack:
+        current, children_done = stack.pop()
+        if current is None:
+            continue
+        entry = index['nodes'][current]
+        if not children_done:
+            stack.append((current, True))
+            stack.append((entry.get('right_child'), False))
+            stack.append((entry.get('left_child'), False))
+            continue
+        nodes[current] = json_node_to_node(entry, nodes[entry.get('left_child')],
+                                           nodes[entry.get('right_child')])
+    return nodes[node_id]
+
+
+# Reconstruct a Node object from a JSON representation, every node after its
+# children.
+def json_to_node(json_tree):
+    nodes = {id(None): None}
+    stack = [(json_tree, False)]
+    while stack:
+        json_node, children_done = stack.pop()
+        if json_node is None:
+            continue
+        if not children_done:
+            stack.append((json_node, True))
+            stack.append((json_node.get('right_child'), False))
+            stack.append((json_node.get('left_child'), False))
+            continue
+        nodes[id(json_node)] = json_node_to_node(
+            json_node, nodes[id(json_node.get('left_child'))],
+            nodes[id(json_node.get('right_child'))])
+    return nodes[id(json_tree)]
 
-# Reconstruct a Node object from a JSON representation.
-def json_to_node(json_node):
-    if json_node is None:
-        return None
 
-    node = Node(json_node['node_type'],
-                json_to_node(json_node.get('left_child')),
-                json_to_node(json_node.get('right_child')))
+# Node of one JSON node given its reconstructed children
+def json_node_to_node(json_node, left_child, right_child):
+    node = Node(json_node['node_type'], left_child, right_child)
 
     if node.get_node_type() == 'rename':
         if 'new_columns' in json_node:
@@ -943,60 +3078,182 @@ def json_to_node(json_node):
     return node
 
 
-def get_node_info_from_db(node_id, json_tree, db):
+MAX_TEMP_TABLES = 256
+
+
+# Materialize the interior nodes of tree as connection-scoped TEMP tables,
+# each built from the tables of its children. A table is named after the
+# structure key of its node (structure_keys), so identical subtrees of any
+# query share it. Tables are kept per connection in LRU order and all dropped once the
+# database has changed. Returns {TEMP_N: table name} for generateSQL.
+def materialize_tree(tree, db):
+    version = get_data_version(db.dbfile)
+    state = _materialized.get(id(db.conn))
+    if state is None or state[0] != version:
+        if state is not None:
+            for name in state[1]:
+                db.conn.execute("drop table if exists temp." + name)
+        state = (version, OrderedDict())
+        _materialized[id(db.conn)] = state
+    tables = state[1]
+
+    materialized = {}
+    _materialize(tree, db, tables, materialized)
+
+    used = set(materialized.values())
+    while len(tables) > MAX_TEMP_TABLES:
+        name = next(iter(tables))
+        if name in used:
+            break
+        db.conn.execute("drop table if exists temp." + name)
+        del tables[name]
+    return materialized
+
+
+# a table is built after the tables of its children; the subtrees of tables
+# already built are not visited
+def _materialize(tree, db, tables, materialized):
+    keys = structure_keys(tree)
+    stack = [(tree, None)]
+    while stack:
+        node, name = stack.pop()
+        if node is None or node.get_node_type() == 'relation':
+            continue
+        if name is None:
+            name = "MAT_" + keys[id(node)][:16]
+            if name in tables:
+                tables.move_to_end(name)
+                materialized[node.get_relation_name()] = name
+                continue
+            stack.append((node, name))
+            stack.append((node.get_right_child(), None))
+            stack.append((node.get_left_child(), None))
+            continue
+        # CREATE TABLE ... AS would give every column the affinity of the
+        # left operand of a compound select, converting the values of the
+        # right one; columns without a type keep every value as it is
+        query = generateSQL(node, db, materialized)
+        db.conn.execute("create temp table " + name + " as select * from (" +
+                        query + ") where 0")
+        columns = [row[1] for row in
+                   db.conn.execute("select * from pragma_table_info(?, 'temp')", (name,))]
+        db.conn.execute("drop table temp." + name)
+        db.conn.execute("create temp table " + name + " (" +
+                        ", ".join('"' + col.replace('"', '""') + '"' for col in columns) + ")")
+        db.conn.execute("insert into temp." + name + " " + query)
+        tables[name] = None
+        materialized[node.get_relation_name()] = name
+
+
+# Forget the node plans (explain_node), query results (result_cache) and the
+# TEMP tables materialized on the connection of db by earlier queries
+def clear_caches(db):
+    with _plan_lock:
+        _plan_cache.clear()
+    result_cache.clear()
+    state = _materialized.pop(id(db.conn), None)
+    if state is not None:
+        for name in state[1]:
+            db.conn.execute("drop table if exists temp." + name)
+
+
+# Run the SQL of the node with the given node_id of json_tree, a JSON tree or
+# the flat table of one (index_tree). When page is given, only that page of
+# rows_per_page rows is fetched (LIMIT/OFFSET) and the total is taken from a
+# separate count(*) query instead of fetching every row.
+# With optimize, the SQL is generated from the optimized subtree; with
+# materialize, the subtree is read from TEMP tables (materialize_tree).
+# Results are served from result_cache when possible, keyed by the CTE SQL of
+# the node and the way it is run, and the subtree is only rebuilt when they
+# are not.
+def get_node_info_from_db(node_id, json_tree, db, page=None, rows_per_page=8,
+                          materialize=False, optimize=False):
     try:
-        node_json = get_node_by_id(json_tree, node_id)
+        node_json = find_node(json_tree, node_id)
 
         if node_json is None:
             return {'error': 'Node not found in the tree.'}
 
-        node = json_to_node(node_json)
-        query = generateSQL(node, db)
-
-        c = db.conn.cursor()
-        c.execute(query)
-        records = c.fetchall()
-
-        columns = [desc[0] for desc in c.description]
-
-        qualified_columns = []
-        for col in columns:
-
-            if col.startswith('TEMP_'):
-                col_name = col.split('.')[-1]
-                qualified_columns.append(col_name)
+        # the CTE SQL of the node is the key of its results
+        built = {}
+        with timed('generate sql'):
+            if 'nodes' in json_tree:
+                key_sql = index_cte_sql(json_tree, node_id)
             else:
-                qualified_columns.append(col)
-
-        return {'columns': qualified_columns, 'rows': records}
+                built['node'] = json_to_node(node_json)
+                key_sql = generateCTESQL(built['node'], db)
+            if not optimize and not materialize:
+                built['query'] = key_sql
+        query = lambda: node_query(json_tree, node_json, db, materialize, optimize, built)
+        mode = (bool(materialize), bool(optimize))
+
+        if page is None:
+            _, records = execute_cached(db, query, key_sql=key_sql, mode=mode)
+            row_count = len(records)
+        else:
+            _, count = execute_cached(db, lambda: "select count(*) from (" + query() + ")",
+                                      key_sql="select count(*) from (" + key_sql + ")",
+                                      mode=mode)
+            row_count = count[0][0]
+            max_page = max((row_count - 1) // rows_per_page, 0)
+            page = min(max(page, 0), max_page)
+            _, records = execute_cached(
+                db, lambda: query() + " limit ? offset ?", (rows_per_page, page * rows_per_page),
+                key_sql=key_sql + " limit ? offset ?", mode=mode)
+
+        # TEMP tables and rewritten queries do not keep the column names of
+        # the node, so they are taken from its attributes
+        return {'columns': node_json['attributes'], 'rows': records,
+                'row_count': row_count, 'page': page}
 
     except Exception as e:
         return {'error': str(e)}
 
 
+# SQL run for the node node_json of json_tree: from its optimized subtree with
+# optimize, reading TEMP tables with materialize (materialize_tree), else its
+# CTE query, which get_node_info_from_db has put in built['query'] already.
+# It is built once, into built['query'], from the subtree in built['node'] if
+# that has been rebuilt already; the subtree is only rebuilt from a flat
+# table when the optimizer or materialize_tree needs its Node objects.
+def node_query(json_tree, node_json, db, materialize, optimize, built):
+    if 'query' in built:
+        return built['query']
+    node = built.get('node')
+    if node is None:
+        node = index_to_node(json_tree, node_json['node_id'])
+    if optimize:
+        with timed('optimize'):
+            node = optimize_tree(node, db)
+    if materialize:
+        with timed('materialize'):
+            materialized = materialize_tree(node, db)
+        with timed('generate sql'):
+            built['query'] = generateSQL(node, db, materialized)
+    else:
+        with timed('generate sql'):
+            built['query'] = generateCTESQL(node, db)
+    return built['query']
+
+
 def fetch_schema_info(db_path):
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
+        conn = get_connection(db_path)
+        try:
+            tables = get_schema_catalog(db_path, conn)
+        finally:
+            release_connection(db_path, conn)
 
         schema_info = {}
-        for table_name in tables:
-            table_name = table_name[0]
-            cursor.execute(f"PRAGMA table_info({table_name})")
-            columns = cursor.fetchall()
-
+        for table_name, columns in tables.items():
             schema_info[table_name] = []
             for col in columns:
-                base_type = col[2].split('(')[0]
+                base_type = col[1].split('(')[0]
                 schema_info[table_name].append({
-                    'attribute': col[1],
+                    'attribute': col[0],
                     'domain': base_type
                 })
 
-        conn.close()
         return schema_info
 
     except sqlite3.Error as e:
@@ -1007,12 +3264,60 @@ def fetch_schema_info(db_path):
 def main():
     db = SQLite3()
     db.open(sys.argv[1])
+    try:
+        command_loop(db)
+    finally:
+        db.close()
+
 
+def command_loop(db):
     while True:
         data = read_input()
+        # the command word and its arguments, without the ;
+        words = data.strip()[:-1].split()
+        command = words[0] if words else ''
         if data == 'schema;':
             db.displayDatabaseSchema()
             continue
+        if command == "advise":
+            mode = words[1] if len(words) == 2 else ''
+            if mode in ['off', 'report', 'temp', 'persist']:
+                global index_advice
+                index_advice = mode
+            else:
+                print("advise off|report|temp|persist;")
+            continue
+        if command == "backend":
+            name = words[1] if len(words) == 2 else ''
+            if name == 'columnar' and not numpy_available():
+                print("the columnar backend requires numpy")
+            elif name in ['sqlite', 'columnar']:
+                global query_backend
+                query_backend = name
+            else:
+                print("backend sqlite|columnar;")
+            continue
+        if command == "output":
+            if len(words) == 2 and words[1] in ['all', 'stream']:
+                global display_mode
+                display_mode = (words[1], None)
+            elif len(words) == 3 and words[1] in ['first', 'sample'] and words[2].isdigit():
+                display_mode = (words[1], int(words[2]))
+            else:
+                print("output all|stream|first n|sample n;")
+            continue
+        if command == "timing":
+            if len(words) == 2 and words[1] in ['on', 'off']:
+                global timing_enabled
+                timing_enabled = words[1] == 'on'
+            else:
+                print("timing on|off;")
+            continue
+        if data == 'analyze;':
+            # gather the statistics used to order joins
+            db.conn.execute("analyze")
+            db.conn.commit()
+            continue
         if data.strip().split()[0] == "source":
             filename = data.strip().split()[1][:-1]
             execute_file(filename, db)
@@ -1020,32 +3325,21 @@ def main():
         if data == 'help;' or data == "h;":
             print("\nschema; 		# to see schema")
             print("source filename; 	# to run query in file")
+            print("analyze; 		# to gather join statistics")
+            print("advise mode;		# index advice: off, report, temp or persist")
+            print("backend name;		# run queries on sqlite or columnar")
+            print("output mode;		# print all, stream, first n or sample n tuples")
+            print("timing on|off;		# print the time spent in each phase")
             print("query terminated with ;	# to run query")
             print("exit; or quit; or q; 	# to exit\n")
             continue
         if data == 'exit;' or data == "quit;" or data == "q;":
             break
-        try:
-            tree = parser.parse(data)
-        except Exception as inst:
-            print(inst.args[0])
-            continue
-        # print("********************************")
-        # tree.print_tree(0)
-        # print("********************************")
-        set_temp_table_names(tree)
-        msg = semantic_checks(tree, db)
-        # print("********************************")
-        # tree.print_tree(0)
-        # print("********************************")
-        if msg == 'OK':
-            # print('Passed semantic checks')
-            query = generateSQL(tree, db)
-            db.displayQueryResults(query, tree)
-        else:
-            print(msg)
-    db.close()
+        run_query(data, db)
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['--build-tables']:
+        build_tables()
+    else:
+        main()
@@ -1,4 +1,5 @@
 from doctest import debug
+import atexit
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output, State, ALL
@@ -6,8 +7,39 @@ import dash_cytoscape as cyto
 import os
 from RAP import *
 import re
+import json
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 
 DB_FOLDER = 'databases'
+ROWS_PER_PAGE = 8
+# read node results from per-connection TEMP tables (see materialize_tree)
+MATERIALIZE_NODES = True
+# run node SQL through the logical optimizer (see optimize_tree)
+OPTIMIZE_QUERIES = True
+# Attach the EXPLAIN QUERY PLAN of every node to the tree and highlight heavy
+# nodes; with TIME_NODES every node is also evaluated once to time it
+EXPLAIN_NODES = True
+TIME_NODES = False
+# The tree of the submitted query, with the plans of its nodes, stays on the
+# server in a session; the browser only keeps its token in tree-store.
+# Sessions are kept in an SQLite database, one row per node of their flat
+# node table (index_tree), so that every worker process of the app can serve
+# them and a click only reads the subtree of the clicked node. The database
+# is SESSION_DB, taken from the RA_VIZ_SESSION_DB environment variable, which
+# a server starting its workers on its own sets to a file in a directory only
+# it can read; otherwise it is made in a new private directory of this
+# instance at first use (session_db), which is removed at exit and which the
+# workers started by the server inherit. Sessions idle for SESSION_TTL
+# seconds, and the least recently used ones beyond SESSION_CACHE_BYTES of
+# JSON in all, are dropped.
+SESSION_DB = os.environ.get('RA_VIZ_SESSION_DB')
+SESSION_CACHE_BYTES = 64*1024*1024
+SESSION_TTL = 3600
 
 app = dash.Dash(__name__)
 
@@ -27,6 +59,95 @@ def get_db_files():
     return [{'label': f, 'value': f} for f in db_files]
 
 
+_session_lock = threading.Lock()
+_session_ready = False
+_session_conns = threading.local()
+
+
+# Path of SESSION_DB, with its file and tables created by the first call of
+# this process. The file holds the trees and tokens of all sessions, so it is
+# only readable by its owner.
+def session_db():
+    global SESSION_DB, _session_ready
+    with _session_lock:
+        if SESSION_DB is None:
+            folder = tempfile.mkdtemp(prefix='ra-viz-')
+            atexit.register(shutil.rmtree, folder, ignore_errors=True)
+            SESSION_DB = os.path.join(folder, 'sessions.db')
+        if not _session_ready:
+            os.close(os.open(SESSION_DB, os.O_RDWR | os.O_CREAT |
+                             getattr(os, 'O_NOFOLLOW', 0), 0o600))
+            conn = sqlite3.connect(SESSION_DB, timeout=30)
+            try:
+                with conn:
+                    conn.execute("pragma journal_mode=wal")
+                    conn.execute("create table if not exists sessions (token text "
+                                 "primary key, used real, size integer)")
+                    conn.execute("create table if not exists session_nodes (token text, "
+                                 "node_id text, left_child text, right_child text, "
+                                 "data text, primary key (token, node_id))")
+            finally:
+                conn.close()
+            _session_ready = True
+    return SESSION_DB
+
+
+# connection of this thread to SESSION_DB
+def open_sessions():
+    conn = getattr(_session_conns, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(session_db(), timeout=30)
+        _session_conns.conn = conn
+    return conn
+
+
+# Keep index in a new session and return its token
+def store_session(index):
+    token = secrets.token_urlsafe(16)
+    rows = [(token, node_id, entry.get('left_child'), entry.get('right_child'),
+             json.dumps(entry)) for node_id, entry in index['nodes'].items()]
+    now = time.time()
+    conn = open_sessions()
+    with conn:
+        conn.execute("insert into sessions values (?, ?, ?)",
+                     (token, now, sum(len(row[4]) for row in rows)))
+        conn.executemany("insert into session_nodes values (?, ?, ?, ?, ?)", rows)
+        dropped = [old for old, in conn.execute(
+            "select token from sessions where used < ?", (now - SESSION_TTL,))]
+        total = 0
+        for old, size in conn.execute(
+                "select token, size from sessions where used >= ? order by used desc",
+                (now - SESSION_TTL,)).fetchall():
+            total += size
+            if total > SESSION_CACHE_BYTES and old != token:
+                dropped.append(old)
+        for old in dropped:
+            conn.execute("delete from session_nodes where token = ?", (old,))
+            conn.execute("delete from sessions where token = ?", (old,))
+    return token
+
+
+# The flat node table of the subtree of node_id in the session with token,
+# or None if the session has expired
+def load_session(token, node_id):
+    now = time.time()
+    conn = open_sessions()
+    with conn:
+        if conn.execute("update sessions set used = ? where token = ? and used >= ?",
+                        (now, token, now - SESSION_TTL)).rowcount == 0:
+            return None
+        rows = conn.execute(
+            "with recursive subtree(node_id) as (select ? union all "
+            "select case side when 0 then left_child else right_child end "
+            "from subtree join session_nodes n on n.token = ? and n.node_id = subtree.node_id, "
+            "(select 0 side union all select 1) "
+            "where (case side when 0 then left_child else right_child end) is not null) "
+            "select n.node_id, n.data from subtree join session_nodes n "
+            "on n.token = ? and n.node_id = subtree.node_id",
+            (node_id, token, token)).fetchall()
+    return {'root': node_id, 'nodes': {row[0]: json.loads(row[1]) for row in rows}}
+
+
 def json_to_cytoscape_elements(json_tree, parent_id=None, elements=None, node_counter=[0], x=0, y=0, x_offset=150, y_offset=100, min_separation=50, level_positions=None):
     if elements is None:
         elements = []
@@ -34,71 +155,71 @@ def json_to_cytoscape_elements(json_tree, parent_id=None, elements=None, node_co
     if level_positions is None:
         level_positions = {}
 
-    if json_tree is None:
-        return elements
-
-    node_id = json_tree['node_id']
-    node_label = json_tree.get('node_type', 'Unknown')
-
-    if json_tree.get('node_type') == "relation":
-        node_label = json_tree.get('relation_name', 'Unknown Relation')
-    elif json_tree.get('node_type') == "project":
-        attributes = ', '.join(json_tree.get('columns', []))
-        node_label += f"\n{attributes}"
-    elif json_tree.get('node_type') == 'select':
-        conditions = [
-            f"{cond[1]} {cond[2]} {cond[4]}" for cond in json_tree.get('conditions', [])
-        ]
-        node_label += f"\n{' and '.join(conditions)}"
-    elif json_tree.get('node_type') == 'rename':
-        new_columns = ', '.join(json_tree.get('new_columns', []))
-        node_label += f"\n{new_columns}"
-
-    if y not in level_positions:
-        level_positions[y] = []
-
-    overlap_detected = False
-    for pos in level_positions[y]:
-        if abs(pos - x) < min_separation:
-            overlap_detected = True
-            break
-
-    if overlap_detected and parent_id:
-        y += y_offset
-
-    level_positions[y].append(x)
+    # preorder with an explicit stack, left subtree first, so that very deep
+    # trees do not hit the recursion limit
+    stack = [(json_tree, parent_id, x, y)]
+    while stack:
+        json_tree, parent_id, x, y = stack.pop()
+        if json_tree is None:
+            continue
+
+        node_id = json_tree['node_id']
+        node_label = json_tree.get('node_type', 'Unknown')
+
+        if json_tree.get('node_type') == "relation":
+            node_label = json_tree.get('relation_name', 'Unknown Relation')
+        elif json_tree.get('node_type') == "project":
+            attributes = ', '.join(json_tree.get('columns', []))
+            node_label += f"\n{attributes}"
+        elif json_tree.get('node_type') == 'select':
+            conditions = [
+                f"{cond[1]} {cond[2]} {cond[4]}" for cond in json_tree.get('conditions', [])
+            ]
+            node_label += f"\n{' and '.join(conditions)}"
+        elif json_tree.get('node_type') == 'rename':
+            new_columns = ', '.join(json_tree.get('new_columns', []))
+            node_label += f"\n{new_columns}"
+
+        if y not in level_positions:
+            level_positions[y] = []
+
+        overlap_detected = False
+        for pos in level_positions[y]:
+            if abs(pos - x) < min_separation:
+                overlap_detected = True
+                break
+
+        if overlap_detected and parent_id:
+            y += y_offset
+
+        level_positions[y].append(x)
+
+        node_data = {'id': node_id, 'label': node_label}
+        if json_tree.get('plan'):
+            # the plan itself is shown from the session
+            node_data['heavy'] = len(json_tree['plan']['heavy'])
+        if json_tree.get('shared'):
+            node_data['shared'] = json_tree['shared']
 
-    elements.append({
-        'data': {'id': node_id, 'label': node_label},
-        'position': {'x': x, 'y': y}
-    })
-
-    if parent_id:
         elements.append({
-            'data': {'source': parent_id, 'target': node_id}
+            'data': node_data,
+            'position': {'x': x, 'y': y}
         })
 
-    node_counter[0] += 1
-
-    if json_tree.get('left_child') and json_tree.get('right_child'):
-        json_to_cytoscape_elements(
-            json_tree['left_child'], node_id, elements, node_counter, x -
-            x_offset, y + y_offset, x_offset, y_offset, min_separation, level_positions
-        )
-        json_to_cytoscape_elements(
-            json_tree['right_child'], node_id, elements, node_counter, x +
-            x_offset, y + y_offset, x_offset, y_offset, min_separation, level_positions
-        )
-    elif json_tree.get('left_child'):
-        json_to_cytoscape_elements(
-            json_tree['left_child'], node_id, elements, node_counter, x, y +
-            y_offset, x_offset, y_offset, min_separation, level_positions
-        )
-    elif json_tree.get('right_child'):
-        json_to_cytoscape_elements(
-            json_tree['right_child'], node_id, elements, node_counter, x, y +
-            y_offset, x_offset, y_offset, min_separation, level_positions
-        )
+        if parent_id:
+            elements.append({
+                'data': {'source': parent_id, 'target': node_id}
+            })
+
+        node_counter[0] += 1
+
+        if json_tree.get('left_child') and json_tree.get('right_child'):
+            stack.append((json_tree['right_child'], node_id, x + x_offset, y + y_offset))
+            stack.append((json_tree['left_child'], node_id, x - x_offset, y + y_offset))
+        elif json_tree.get('left_child'):
+            stack.append((json_tree['left_child'], node_id, x, y + y_offset))
+        elif json_tree.get('right_child'):
+            stack.append((json_tree['right_child'], node_id, x, y + y_offset))
 
     return elements
 
@@ -135,6 +256,33 @@ def create_table_from_node_info(node_info):
     )
 
 
+# Query plan of a node: why it is heavy, estimated rows and the plan lines
+def create_plan_details(plan):
+    summary = f"Query plan: ~{plan['estimated_rows']} rows"
+    if 'time_ms' in plan:
+        summary += f", {plan['time_ms']:.3f} ms"
+    if plan['heavy']:
+        summary += " - " + ", ".join(plan['heavy'])
+    return html.Details(className='plan-details', children=[
+        html.Summary(summary),
+        html.Pre("\n".join(plan['summary']))
+    ])
+
+
+# Phase times of a query as a two column table
+def create_timing_table(title, phases):
+    if not phases:
+        return ""
+    rows = [html.Tr([html.Td(phase), html.Td(f"{seconds * 1000:.3f} ms")])
+            for phase, seconds in phases.items()]
+    rows.append(html.Tr([html.Th("total"),
+                         html.Th(f"{sum(phases.values()) * 1000:.3f} ms")]))
+    return html.Div([
+        html.H4(title),
+        html.Table(className='classic-table', children=[html.Tbody(rows)])
+    ])
+
+
 cytoscape_stylesheet = [
     {
         'selector': 'node',
@@ -155,6 +303,22 @@ cytoscape_stylesheet = [
             'line-color': '#CCCCCC',
         }
     },
+    {
+        'selector': 'node[heavy > 0]',
+        'style': {
+            'background-color': '#E87722',
+            'border-width': '4px',
+            'border-color': '#CC0000',
+        }
+    },
+    {
+        'selector': 'node[shared]',
+        'style': {
+            'border-width': '6px',
+            'border-style': 'double',
+            'border-color': '#7B2FBE',
+        }
+    },
     {
         'selector': ':selected',
         'style': {
@@ -237,6 +401,11 @@ def main_layout():
                     html.Summary("Schema Information"),
                     html.Div(id="schema-info",
                              children="Schema Info Placeholder")
+                ]),
+                html.Details(id="timing-container", children=[
+                    html.Summary("Query Timing"),
+                    html.Div(id="tree-timing"),
+                    html.Div(id="node-timing")
                 ])
             ]),
             html.Div(id="modal", className="modal", style={"display": "none"}, children=[
@@ -424,7 +593,8 @@ def display_schema_info(selected_db):
      Output('tree-store', 'data'),
      Output('db-path-store', 'data'),
      Output('error-div', 'children'),
-     Output('error-div', 'style')],
+     Output('error-div', 'style'),
+     Output('tree-timing', 'children')],
     [Input('submit-btn', 'n_clicks'),
      Input('db-dropdown', 'value')],
     [State('query-input', 'value')]
@@ -432,94 +602,120 @@ def display_schema_info(selected_db):
 def update_tree(n_clicks, selected_db, query):
     ctx = dash.callback_context
     if ctx.triggered and ctx.triggered[0]['prop_id'].startswith('db-dropdown'):
-        return [], {}, "", "", {'display': 'none'}
+        return [], {}, "", "", {'display': 'none'}, ""
 
     if n_clicks is None:
-        return [], {}, "", "", {'display': 'none'}
+        return [], {}, "", "", {'display': 'none'}, ""
 
     if not selected_db:
-        return [], {}, "", "Please select a database.", {'display': 'block'}
+        return [], {}, "", "Please select a database.", {'display': 'block'}, ""
 
     if not query:
-        return [], {}, "", "Please enter a query.", {'display': 'block'}
+        return [], {}, "", "Please enter a query.", {'display': 'block'}, ""
 
     if n_clicks and selected_db and query:
+        db = SQLite3()
+        start_timing()
         try:
             db_path = os.path.join(DB_FOLDER, selected_db)
-            db = SQLite3()
             db.open(db_path)
 
-            json_tree = generate_tree_from_query(query, db, node_counter=[0])
+            json_tree = generate_tree_from_query(query, db, node_counter=[0],
+                                                 explain=EXPLAIN_NODES,
+                                                 time_nodes=TIME_NODES)
 
             if 'error' in json_tree:
                 raise Exception(
                     f"Error in query: {json_tree['error']}. Is the right database selected?")
 
-            elements = json_to_cytoscape_elements(json_tree)
+            with timed('elements'):
+                elements = json_to_cytoscape_elements(json_tree)
 
-            db.close()
+            # clicks look nodes up in a flat table instead of the tree
+            with timed('index'):
+                token = store_session(index_tree(json_tree, db))
 
-            return elements, json_tree, db_path, "", {'display': 'none'}
+            return elements, {'token': token}, db_path, "", {'display': 'none'}, \
+                create_timing_table("Query tree", stop_timing())
 
         except Exception as e:
             # Show the error message
-            return [], {}, str(e), str(e), {'display': 'block'}
+            return [], {}, str(e), str(e), {'display': 'block'}, \
+                create_timing_table("Query tree", stop_timing())
+        finally:
+            db.close()
 
 
 @app.callback(
     [Output('node-table-placeholder', 'children'),
-     Output('row-count', 'data')],
+     Output('row-count', 'data'),
+     Output('node-timing', 'children')],
     [Input('cytoscape-tree', 'tapNodeData'),
      Input('db-dropdown', 'value'),
      Input('current-page', 'data')],
     [State('tree-store', 'data'), State('db-path-store', 'data')]
 )
-def display_node_info(node_data, selected_db, current_page, json_tree, db_path):
+def display_node_info(node_data, selected_db, current_page, tree_store, db_path):
     ctx = dash.callback_context
 
     if ctx.triggered and ctx.triggered[0]['prop_id'].startswith('db-dropdown'):
-        return "Click node to see info.", 0
+        return "Click node to see info.", 0, ""
 
     if node_data:
+        db = SQLite3()
+        start_timing()
         try:
             node_id = node_data['id']
-            db = SQLite3()
+            index = load_session((tree_store or {}).get('token'), node_id)
+            if index is None:
+                return html.Div([html.P("The query tree has expired, please submit the "
+                                        "query again.")]), 0, \
+                    create_timing_table("Node", stop_timing())
             db.open(db_path)
 
-            node_info = get_node_info_from_db(node_id, json_tree, db)
-            db.close()
+            node_info = get_node_info_from_db(
+                node_id, index, db, page=current_page, rows_per_page=ROWS_PER_PAGE,
+                materialize=MATERIALIZE_NODES, optimize=OPTIMIZE_QUERIES)
 
             if 'error' in node_info:
-                return html.Div([html.P(f"Error: {node_info['error']}")]), 0
-
-            rows_per_page = 8
-            total_rows = len(node_info['rows'])
-            max_page = (total_rows - 1) // rows_per_page
-
-            current_page = min(current_page, max_page)
-            start_index = current_page * rows_per_page
-            end_index = start_index + rows_per_page
-            visible_rows = node_info['rows'][start_index:end_index]
-
-            columns = node_info['columns']
-            table_header = [html.Th(col) for col in columns]
-            table_body = [html.Tr([html.Td(cell) for cell in row])
-                          for row in visible_rows]
-
-            result_table = html.Table(
-                className='classic-table',
-                children=[
-                    html.Thead(html.Tr(table_header)),
-                    html.Tbody(table_body)
-                ]
-            )
+                return html.Div([html.P(f"Error: {node_info['error']}")]), 0, \
+                    create_timing_table("Node", stop_timing())
+
+            total_rows = node_info['row_count']
+            visible_rows = node_info['rows']
+
+            with timed('table'):
+                columns = node_info['columns']
+                table_header = [html.Th(col) for col in columns]
+                table_body = [html.Tr([html.Td(cell) for cell in row])
+                              for row in visible_rows]
+
+                result_table = html.Table(
+                    className='classic-table',
+                    children=[
+                        html.Thead(html.Tr(table_header)),
+                        html.Tbody(table_body)
+                    ]
+                )
 
-            return result_table, total_rows
+            node_json = index['nodes'][node_id]
+            if node_json.get('plan'):
+                result_table = html.Div([create_plan_details(node_json['plan']), result_table])
+            if node_data.get('shared'):
+                result_table = html.Div([
+                    html.P(className='shared-note',
+                           children=f"Common subexpression: evaluated once for every "
+                                    f"identical subtree (first at {node_data['shared']})"),
+                    result_table])
+
+            return result_table, total_rows, create_timing_table("Node", stop_timing())
 
         except Exception as e:
-            return f"Error occurred: {str(e)}", 0
+            return f"Error occurred: {str(e)}", 0, create_timing_table("Node", stop_timing())
+        finally:
+            db.close()
 
-    return "Click node to see info.", 0
+    return "Click node to see info.", 0, ""
 
 
 @app.callback(
@@ -559,5 +755,7 @@ app.clientside_callback(
 
 
 if __name__ == '__main__':
+    # the workers started by the server share the sessions of this instance
+    os.environ['RA_VIZ_SESSION_DB'] = session_db()
     # app.run_server(debug=True)
     app.run_server(host='0.0.0.0', port=5020)
@@ -0,0 +1,163 @@
+# Run every query of many query files against one or more databases in a
+# process pool, writing one result record per (query, database) as JSONL or
+# CSV with its status, answer size, an order independent digest of the
+# answer and the time spent in each phase.
+#
+#   python batch.py [-d db ...] [-j jobs] [-f jsonl|csv] [-o out] path ...
+#
+# A path is a query file or a directory searched for query files. A file may
+# hold several ;-terminated queries; lines starting with # are comments.
+
+import argparse
+import contextlib
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from RAP import *
+
+FIELDS = ['file', 'query', 'database', 'status', 'message', 'rows', 'digest',
+          'parse_ms', 'check_ms', 'plan_ms', 'execute_ms', 'total_ms']
+
+
+# the ;-terminated queries of a file, without comment lines
+def read_queries(filename):
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    text = " ".join([line for line in lines if len(line.strip()) > 0 and
+                     line.strip()[0] != "#"])
+    queries = []
+    start = 0
+    quoted = False
+    for i, ch in enumerate(text):
+        if ch == "'":
+            quoted = not quoted
+        elif ch == ';' and not quoted:
+            queries.append(text[start:i + 1].strip())
+            start = i + 1
+    if len(text[start:].strip()) > 0:
+        queries.append(text[start:].strip())
+    return queries
+
+
+def query_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files += [os.path.join(root, name) for name in sorted(names)
+                          if not name.startswith('.')]
+        else:
+            files.append(path)
+    return files
+
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+# run one query against one database; output printed by the lexer or parser
+# is returned as the message instead of being written to stdout
+def run_task(task):
+    filename, number, query, dbfile = task
+    result = {'file': filename, 'query': number, 'database': dbfile, 'status': 'ok',
+              'message': '', 'rows': None, 'digest': None, 'parse_ms': None,
+              'check_ms': None, 'plan_ms': None, 'execute_ms': None}
+    db = SQLite3()
+    captured = io.StringIO()
+    begin = time.perf_counter()
+    try:
+        db.open(dbfile)
+        with contextlib.redirect_stdout(captured):
+            start = time.perf_counter()
+            try:
+                tree = parser.parse(query)
+            except Exception as inst:
+                result['status'] = 'syntax error'
+                result['message'] = str(inst.args[0])
+                return result
+            result['parse_ms'] = elapsed_ms(start)
+            if tree is None:
+                result['status'] = 'syntax error'
+                return result
+            start = time.perf_counter()
+            set_temp_table_names(tree)
+            msg = semantic_checks(tree, db)
+            result['check_ms'] = elapsed_ms(start)
+            if msg != 'OK':
+                result['status'] = 'semantic error'
+                result['message'] = msg
+                return result
+            start = time.perf_counter()
+            sql = generateCTESQL(optimize_tree(tree, db), db)
+            result['plan_ms'] = elapsed_ms(start)
+            start = time.perf_counter()
+            records = db.conn.execute(sql).fetchall()
+            result['execute_ms'] = elapsed_ms(start)
+        result['rows'] = len(records)
+        result['digest'] = hashlib.sha1(
+            "\n".join(sorted(map(repr, records))).encode()).hexdigest()
+    except Exception as inst:
+        result['status'] = 'error'
+        result['message'] = str(inst)
+    finally:
+        db.close()
+        result['total_ms'] = elapsed_ms(begin)
+        if len(captured.getvalue().strip()) > 0:
+            result['message'] = (captured.getvalue().strip() + " " +
+                                 result['message']).strip()
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Run relational algebra query files in batch")
+    ap.add_argument('paths', nargs='+', help="query files or directories")
+    ap.add_argument('-d', '--db', action='append',
+                    help="database to run the queries on (repeatable, default: databases/*.db)")
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                    help="number of worker processes")
+    ap.add_argument('-f', '--format', choices=['jsonl', 'csv'], default='jsonl')
+    ap.add_argument('-o', '--output', help="output file (default: stdout)")
+    args = ap.parse_args()
+
+    dbfiles = args.db
+    if not dbfiles:
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'databases')
+        dbfiles = sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                         if name.endswith('.db'))
+    tasks = []
+    for filename in query_files(args.paths):
+        for number, query in enumerate(read_queries(filename)):
+            for dbfile in dbfiles:
+                tasks.append((filename, number + 1, query, dbfile))
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = None
+    if args.format == 'csv':
+        writer = csv.DictWriter(out, fieldnames=FIELDS)
+        writer.writeheader()
+    if args.jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=args.jobs)
+        results = pool.map(run_task, tasks, chunksize=max(1, len(tasks) // (args.jobs * 8)))
+    else:
+        pool = None
+        results = map(run_task, tasks)
+    for result in results:
+        if writer is not None:
+            writer.writerow(result)
+        else:
+            out.write(json.dumps(result) + "\n")
+    if pool is not None:
+        pool.shutdown()
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Latency of clicking the nodes of a query tree in the app, with the tree
+# kept as nested JSON (searched and rebuilt on every click) and as the flat
+# table of index_tree. Every node of the tree is clicked twice with the app's
+# settings; the second click finds its page in result_cache. Trees are the
+# union, join and select chains of deeptree.py and the bundled queries.
+#
+#   python benchmarks/clicks.py [depth ...]
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from RAP import *
+from common import ROOT, SHAPES, workload
+
+
+# seconds to click every node of the tree in store, first and second time
+def click_time(store, nodes, db):
+    times = []
+    for _ in range(2):
+        start = time.perf_counter()
+        for i in range(nodes):
+            get_node_info_from_db('node_' + str(i), store, db, page=0,
+                                  materialize=True, optimize=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def compare(label, query, db):
+    counter = [0]
+    json_tree = generate_tree_from_query(query, db, counter)
+    if 'error' in json_tree:
+        print("%-20s %s" % (label, json_tree['error'][:60]))
+        return
+    start = time.perf_counter()
+    index = index_tree(json_tree, db)
+    index_time = time.perf_counter() - start
+    # the stores as they come back from the browser
+    nested = json.loads(json.dumps(json_tree))
+    index = json.loads(json.dumps(index))
+    clear_caches(db)
+    nested_times = click_time(nested, counter[0], db)
+    clear_caches(db)
+    index_times = click_time(index, counter[0], db)
+    print("%-20s %6d %10.4f %10.4f %10.4f %10.4f %10.4f" %
+          (label, counter[0], index_time, nested_times[0], index_times[0],
+           nested_times[1], index_times[1]))
+
+
+def main():
+    depths = [int(arg) for arg in sys.argv[1:]] or [10, 50]
+    print("%-20s %6s %10s %10s %10s %10s %10s" %
+          ("tree", "nodes", "index (s)", "nested (s)", "flat (s)", "again (s)", "flat (s)"))
+    db = SQLite3()
+    db.open(os.path.join(ROOT, 'databases', 'company.db'))
+    for shape, generate in SHAPES:
+        for depth in depths:
+            compare("%s %d" % (shape, depth), generate(depth), db)
+    db.close()
+    for dbname, qnum, query in workload():
+        db = SQLite3()
+        db.open(os.path.join(ROOT, 'databases', dbname + '.db'))
+        compare("%s %s" % (dbname, qnum), query, db)
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Helpers shared by the benchmark scripts: the bundled queries, the machine
+# generated query trees, timing and the app's element builder. Scripts import
+# these from here rather than from each other, so that running one benchmark
+# does not load the others.
+
+import os
+import re
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+REPEAT = 3
+
+
+# (database, number, query) of every query in queries.md
+def workload():
+    with open(os.path.join(ROOT, 'queries.md')) as f:
+        text = f.read()
+    for match in re.finditer(r'<div data-db="(\w+)">(.*?)</div>', text, flags=re.DOTALL):
+        for i, query in enumerate(re.findall(r'```(.*?)```', match.group(2), flags=re.DOTALL)):
+            yield match.group(1), i + 1, query
+
+
+# the queries of queries.md on their database, and the files of queries/ on
+# every database they pass the semantic checks on
+def all_queries():
+    queries = [(dbname, "queries.md#" + str(qnum), query) for dbname, qnum, query in workload()]
+    folder = os.path.join(ROOT, 'queries')
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name)) as f:
+            lines = f.read().splitlines()
+        query = " ".join([line for line in lines if len(line) > 0 and line[0] != "#"])
+        for dbname in sorted(set(q[0] for q in queries)):
+            queries.append((dbname, "queries/" + name, query))
+    return queries
+
+
+# best time of running query on conn over REPEAT runs, and its number of rows
+def best_time(conn, query):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        rows = conn.execute(query).fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(rows)
+
+
+def union_chain(depth):
+    return " union ".join(["project[ssn](employee)"] * depth) + ";"
+
+
+def join_chain(depth):
+    # every works_on is read through its own projection, so that no two join
+    # inputs share a name
+    return "(" * (depth - 1) + "employee" + \
+        " join project[essn,pno,hours](works_on))" * (depth - 1) + ";"
+
+
+def select_chain(depth):
+    return "select[salary>1](" * depth + "employee" + ")" * depth + ";"
+
+
+# selects with distinct conditions, which the optimizer cannot merge into one
+# where clause of SQLite
+def range_chain(depth):
+    return "".join("select[salary>%d](" % i for i in range(1, depth + 1)) + \
+        "employee" + ")" * depth + ";"
+
+
+# query trees of a given depth on company.db
+SHAPES = [('union', union_chain), ('join', join_chain), ('select', select_chain),
+          ('range', range_chain)]
+
+
+# the app's element builder, when dash is installed
+def cytoscape_builder():
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        from app import json_to_cytoscape_elements
+        return json_to_cytoscape_elements
+    except ImportError:
+        return None
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,58 @@
+# Compare running the CTE query of an optimized tree, as the CLI does, with
+# and without common subexpression elimination (share_subexpressions), for
+# every query of queries.md with identical subtrees and for a few written to
+# have them, on scaled-up copies of the bundled databases.
+#
+#   python benchmarks/cse.py [scale factor ...]
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import RAP
+from RAP import *
+from common import ROOT, best_time, workload
+from scaleup import scale_database
+
+SMITH = "select[lname='Smith'](employee join works_on)"
+EXTRA = [
+    ('company', 'smith', "project[pno](" + SMITH + ") union project[essn](" + SMITH + ");"),
+    ('company', 'pairs', "project[essn](works_on join works_on) intersect "
+                         "project[essn](select[hours>10](works_on join works_on));"),
+]
+
+
+def main():
+    factors = [int(arg) for arg in sys.argv[1:]] or [1, 10, 100]
+    tmpdir = tempfile.mkdtemp()
+    print("%-10s %-6s %-6s %8s %12s %12s %8s" %
+          ("database", "query", "scale", "shared", "copies (s)", "shared (s)", "rows"))
+    for factor in factors:
+        scaled = {}
+        for dbname, qnum, query in list(workload()) + EXTRA:
+            if dbname not in scaled:
+                scaled[dbname] = os.path.join(tmpdir, "%s_x%d.db" % (dbname, factor))
+                scale_database(os.path.join(ROOT, 'databases', dbname + '.db'),
+                               scaled[dbname], factor)
+            db = SQLite3()
+            db.open(scaled[dbname])
+            tree = parser.parse(query)
+            set_temp_table_names(tree)
+            shared = semantic_checks(tree, db) == 'OK' and shared_subtrees(tree)
+            if shared:
+                tree = optimize_tree(tree, db)
+                RAP.share_subexpressions = False
+                old, old_rows = best_time(db.conn, generateCTESQL(tree, db))
+                RAP.share_subexpressions = True
+                new, new_rows = best_time(db.conn, generateCTESQL(tree, db))
+                print("%-10s %-6s %-6d %8d %12.4f %12.4f %8s" %
+                      (dbname, qnum, factor, len(shared), old, new,
+                       new_rows if old_rows == new_rows else "%d/%d" % (old_rows, new_rows)))
+            db.close()
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Time the whole-tree passes on machine generated query trees thousands of
+# nodes deep: right-deep union chains, left-deep join chains and nested
+# select chains, with equal and with distinct conditions, on company.db. A
+# pass that fails, for instance with a RecursionError, is reported instead of
+# its time. Besides the passes of the CLI, the passes the app runs on a submit
+# (tree_to_json with the plans of the nodes) and on a click (materialize_tree)
+# are timed, every tree starting from empty caches. The memory held by each
+# checked tree is compared with the size of its SQL.
+#
+#   python benchmarks/deeptree.py [depth ...]
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from RAP import *
+from common import ROOT, SHAPES, cytoscape_builder
+
+PASSES = ['parse', 'temp_names', 'check', 'generate_sql', 'optimize', 'cte_sql', 'execute',
+          'tree_to_json', 'explain', 'materialize', 'node_by_id', 'json_to_node', 'cytoscape']
+
+
+# time of every pass over the tree of query, or the error it failed with;
+# nothing is run on a tree that failed to parse or check
+def time_passes(query, db, cytoscape):
+    clear_caches(db)
+    times = {}
+    state = {}
+    counter = [0]
+    passes = [
+        ('parse', lambda: state.update(tree=parser.parse(query))),
+        ('temp_names', lambda: set_temp_table_names(state['tree'])),
+        ('check', lambda: state.update(msg=semantic_checks(state['tree'], db))),
+        ('generate_sql', lambda: generateSQL(state['tree'], db)),
+        ('optimize', lambda: state.update(optimized=optimize_tree(state['tree'], db))),
+        ('cte_sql', lambda: state.update(sql=generateCTESQL(state['optimized'], db))),
+        ('execute', lambda: db.conn.execute(state['sql']).fetchall()),
+        ('tree_to_json', lambda: state.update(json=tree_to_json(state['tree'], db, counter))),
+        ('explain', lambda: tree_to_json(state['tree'], db, [0], explain=True)),
+        ('materialize', lambda: materialize_tree(state['tree'], db)),
+        # the last node in preorder, the slowest to find
+        ('node_by_id', lambda: get_node_by_id(state['json'], 'node_' + str(counter[0] - 1))),
+        ('json_to_node', lambda: json_to_node(state['json'])),
+        ('cytoscape', lambda: cytoscape(state['json'], node_counter=[0])),
+    ]
+    for name, run in passes:
+        if name == 'cytoscape' and cytoscape is None:
+            continue
+        start = time.perf_counter()
+        try:
+            run()
+        except Exception as inst:
+            times[name] = type(inst).__name__
+            if name in ['parse', 'temp_names', 'check']:
+                break
+            continue
+        times[name] = time.perf_counter() - start
+        if name == 'check' and state['msg'] != 'OK':
+            times[name] = state['msg']
+            break
+    return times
+
+
+# bytes allocated for the checked tree of query, and the length of its SQL
+def tree_memory(query, db):
+    tracemalloc.start()
+    tree = parser.parse(query)
+    set_temp_table_names(tree)
+    semantic_checks(tree, db)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(postorder(tree)), size, len(generateCTESQL(tree, db))
+
+
+def main():
+    depths = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 3000]
+    cytoscape = cytoscape_builder()
+    db = SQLite3()
+    db.open(os.path.join(ROOT, 'databases', 'company.db'))
+    print("%-7s %6s " % ("shape", "depth") + " ".join("%12s" % name for name in PASSES))
+    for shape, generate in SHAPES:
+        for depth in depths:
+            times = time_passes(generate(depth), db, cytoscape)
+            print("%-7s %6d " % (shape, depth) + " ".join(
+                "%12s" % ("-" if name not in times else
+                          "%12.4f" % times[name] if isinstance(times[name], float) else
+                          times[name][:12]) for name in PASSES))
+    print("\n%-7s %6s %8s %10s %10s" % ("shape", "depth", "nodes", "tree (kB)", "SQL (kB)"))
+    for shape, generate in SHAPES:
+        for depth in depths:
+            nodes, size, sql = tree_memory(generate(depth), db)
+            print("%-7s %6d %8d %10.1f %10.1f" % (shape, depth, nodes, size / 1024, sql / 1024))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Resubmitting an edited query in the app: for every bundled query with a
+# numeric select condition, the query is edited by changing that constant.
+# The app's work for the edited query - building its tree with plans, then
+# showing the first page of every node - is timed once from scratch and once
+# right after the same work for the original query, when only the nodes on
+# the path from the edit to the root need new plans and results.
+#
+#   python benchmarks/edits.py [scale factor]
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from RAP import *
+from common import ROOT, all_queries
+from scaleup import scale_database
+
+
+# query with the first number of a select condition increased by one
+def edit(query):
+    match = re.search(r"select\s*\[[^\]]*?[<>=]\s*(\d+)", query)
+    if match is None:
+        return None
+    number = int(match.group(1)) + 1
+    return query[:match.start(1)] + str(number) + query[match.end(1):]
+
+
+# seconds to build the tree of query and to show the first page of every
+# node, with the settings of the app, and the number of nodes; None if the
+# query fails
+def app_time(query, db):
+    counter = [0]
+    start = time.perf_counter()
+    json_tree = generate_tree_from_query(query, db, counter, explain=True)
+    tree_time = time.perf_counter() - start
+    if 'error' in json_tree:
+        return None
+    start = time.perf_counter()
+    for i in range(counter[0]):
+        get_node_info_from_db('node_' + str(i), json_tree, db, page=0,
+                              materialize=True, optimize=True)
+    return tree_time, time.perf_counter() - start, counter[0]
+
+
+def main():
+    factor = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    tmpdir = tempfile.mkdtemp()
+    scaled = {}
+    print("%-10s %-20s %6s %12s %12s %12s %12s" %
+          ("database", "query", "nodes", "tree (s)", "edited (s)", "pages (s)", "edited (s)"))
+    for dbname, name, query in all_queries():
+        edited = edit(query)
+        if edited is None:
+            continue
+        if dbname not in scaled:
+            scaled[dbname] = os.path.join(tmpdir, "%s_x%d.db" % (dbname, factor))
+            scale_database(os.path.join(ROOT, 'databases', dbname + '.db'),
+                           scaled[dbname], factor)
+        db = SQLite3()
+        db.open(scaled[dbname])
+        app_time(edited, db)
+        clear_caches(db)
+        scratch = app_time(edited, db)
+        if scratch is not None:
+            clear_caches(db)
+            app_time(query, db)
+            incremental = app_time(edited, db)
+            print("%-10s %-20s %6d %12.4f %12.4f %12.4f %12.4f" %
+                  (dbname, name, scratch[2], scratch[0], incremental[0], scratch[1],
+                   incremental[1]))
+        db.close()
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Equivalence check of the logical optimizer: every query of queries.md and
+# queries/ is run on every bundled database it passes the semantic checks on,
+# and on scaled-up copies of them (where join reordering sees other
+# statistics), once as written (generateSQL) and once optimized
+# (generateCTESQL of optimize_tree). Both must return the same rows, compared
+# as multisets in the order of their columns.
+#
+#   python benchmarks/equivalence.py [scale factor ...]
+
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from RAP import *
+from common import ROOT, all_queries
+from scaleup import scale_database
+
+
+# None when query does not pass the semantic checks on db, else whether the
+# optimized tree returns the rows of the tree as written
+def equivalent(query, db):
+    tree = parser.parse(query)
+    set_temp_table_names(tree)
+    if semantic_checks(tree, db) != 'OK':
+        return None
+    written = db.conn.execute(generateSQL(tree, db)).fetchall()
+    optimized = db.conn.execute(generateCTESQL(optimize_tree(tree, db), db)).fetchall()
+    return Counter(written) == Counter(optimized)
+
+
+def main():
+    factors = [int(arg) for arg in sys.argv[1:]] or [1, 10]
+    dbnames = sorted(os.path.splitext(name)[0]
+                     for name in os.listdir(os.path.join(ROOT, 'databases'))
+                     if name.endswith('.db'))
+    queries = {}
+    for _, name, query in all_queries():
+        queries.setdefault(name, query)
+    tmpdir = tempfile.mkdtemp()
+    checked = 0
+    bad = []
+    for factor in factors:
+        for dbname in dbnames:
+            dbfile = os.path.join(ROOT, 'databases', dbname + '.db')
+            if factor != 1:
+                scaled = os.path.join(tmpdir, "%s_x%d.db" % (dbname, factor))
+                scale_database(dbfile, scaled, factor)
+                dbfile = scaled
+            db = SQLite3()
+            db.open(dbfile)
+            for name, query in queries.items():
+                try:
+                    same = equivalent(query, db)
+                except Exception as inst:
+                    same = False
+                    print("x%-5d %-10s %-20s failed: %s" % (factor, dbname, name, inst))
+                if same is None:
+                    continue
+                checked += 1
+                if not same:
+                    bad.append((factor, dbname, name))
+            db.close()
+    shutil.rmtree(tmpdir)
+
+    print("%d query runs compared, %d mismatches" % (checked, len(bad)))
+    for factor, dbname, name in bad:
+        print("mismatch: x%d %s %s: %s" % (factor, dbname, name, " ".join(queries[name].split())))
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# Bytes the app sends to the browser for a submitted query and back to the
+# server on every click: the cytoscape elements, and tree-store holding the
+# nested JSON tree with its plans (as before sessions) or a session token.
+# Trees are the chains of deeptree.py and the bundled queries.
+#
+#   python benchmarks/payload.py [depth ...]
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from RAP import *
+from common import ROOT, SHAPES, cytoscape_builder, workload
+
+
+def sizes(label, query, db, cytoscape):
+    json_tree = generate_tree_from_query(query, db, [0], explain=True)
+    if 'error' in json_tree:
+        print("%-20s %s" % (label, json_tree['error'][:60]))
+        return
+    elements = len(json.dumps(cytoscape(json_tree, node_counter=[0]))) if cytoscape else 0
+    print("%-20s %12.1f %12.1f %12d" % (label, elements / 1024,
+                                       len(json.dumps(json_tree)) / 1024,
+                                       len(json.dumps({'token': 'x' * 22}))))
+
+
+def main():
+    depths = [int(arg) for arg in sys.argv[1:]] or [10, 100]
+    cytoscape = cytoscape_builder()
+    print("%-20s %12s %12s %12s" % ("tree", "elements (kB)", "tree (kB)", "token (B)"))
+    db = SQLite3()
+    db.open(os.path.join(ROOT, 'databases', 'company.db'))
+    for shape, generate in SHAPES:
+        for depth in depths:
+            sizes("%s %d" % (shape, depth), generate(depth), db, cytoscape)
+    db.close()
+    for dbname, qnum, query in workload():
+        db = SQLite3()
+        db.open(os.path.join(ROOT, 'databases', dbname + '.db'))
+        sizes("%s %s" % (dbname, qnum), query, db, cytoscape)
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
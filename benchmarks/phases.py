@@ -0,0 +1,146 @@
+# Time every phase of running each bundled query - parsing, temp table
+# naming, semantic checks, SQL generation, optimization, SQLite execution
+# and building the JSON tree and cytoscape elements of the app - on scaled-up
+# copies of the bundled databases. Results are saved as JSON, by default to
+# benchmarks/results/<commit>.json, and can be compared with an earlier run.
+#
+#   python benchmarks/phases.py [-s factor ...] [-o out.json] [--compare old.json]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from RAP import *
+from common import ROOT, all_queries, cytoscape_builder
+from scaleup import scale_database
+
+REPEAT = 5
+PHASES = ['parse', 'temp_names', 'check', 'generate_sql', 'optimize', 'cte_sql',
+          'execute', 'tree_to_json', 'cytoscape']
+REGRESSION = 1.25       # slowdowns reported by --compare
+
+
+def commit_id():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+# best time of every phase over REPEAT runs, or None when the query does not
+# pass the semantic checks on db
+def time_phases(query, db, cytoscape):
+    best = {}
+    for _ in range(REPEAT):
+        times = {}
+        start = time.perf_counter()
+        tree = parser.parse(query)
+        times['parse'] = time.perf_counter() - start
+        start = time.perf_counter()
+        set_temp_table_names(tree)
+        times['temp_names'] = time.perf_counter() - start
+        start = time.perf_counter()
+        msg = semantic_checks(tree, db)
+        times['check'] = time.perf_counter() - start
+        if msg != 'OK':
+            return None
+        start = time.perf_counter()
+        generateSQL(tree, db)
+        times['generate_sql'] = time.perf_counter() - start
+        start = time.perf_counter()
+        optimized = optimize_tree(tree, db)
+        times['optimize'] = time.perf_counter() - start
+        start = time.perf_counter()
+        sql = generateCTESQL(optimized, db)
+        times['cte_sql'] = time.perf_counter() - start
+        start = time.perf_counter()
+        db.conn.execute(sql).fetchall()
+        times['execute'] = time.perf_counter() - start
+        start = time.perf_counter()
+        json_tree = tree_to_json(tree, db, [0])
+        times['tree_to_json'] = time.perf_counter() - start
+        if cytoscape is not None:
+            start = time.perf_counter()
+            cytoscape(json_tree, node_counter=[0])
+            times['cytoscape'] = time.perf_counter() - start
+        for phase, elapsed in times.items():
+            best[phase] = min(best.get(phase, elapsed), elapsed)
+    return best
+
+
+def compare(results, baseline):
+    print("\nchanges against " + baseline['commit'] + " (new/old):")
+    for scale, queries in results['results'].items():
+        old = baseline['results'].get(scale, {})
+        for phase in PHASES:
+            new_total = sum(q.get(phase, 0) for name, q in queries.items() if name in old)
+            old_total = sum(old[name].get(phase, 0) for name in queries if name in old)
+            if old_total > 0:
+                print("  x%-5s %-13s %8.3f" % (scale, phase, new_total / old_total))
+        for name, q in sorted(queries.items()):
+            for phase, elapsed in q.items():
+                before = old.get(name, {}).get(phase)
+                # ignore sub-0.1ms phases, they are mostly timer noise
+                if before and elapsed > 1e-4 and elapsed / before > REGRESSION:
+                    print("  regression x%s %s %s: %.6fs -> %.6fs" %
+                          (scale, name, phase, before, elapsed))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Per-phase query benchmark")
+    ap.add_argument('-s', '--scale', type=int, action='append',
+                    help="scale factor of the databases (repeatable, default 1 and 10)")
+    ap.add_argument('-o', '--output', help="result file (default benchmarks/results/<commit>.json)")
+    ap.add_argument('--compare', help="earlier result file to compare with")
+    args = ap.parse_args()
+
+    results = {'commit': commit_id(), 'repeat': REPEAT, 'results': {}}
+    cytoscape = cytoscape_builder()
+    tmpdir = tempfile.mkdtemp()
+    print("%-6s %-10s %-20s " % ("scale", "database", "query") +
+          " ".join("%12s" % phase for phase in PHASES))
+    for factor in args.scale or [1, 10]:
+        scaled = {}
+        queries = {}
+        for dbname, name, query in all_queries():
+            if dbname not in scaled:
+                scaled[dbname] = os.path.join(tmpdir, "%s_x%d.db" % (dbname, factor))
+                scale_database(os.path.join(ROOT, 'databases', dbname + '.db'),
+                               scaled[dbname], factor)
+            db = SQLite3()
+            db.open(scaled[dbname])
+            try:
+                times = time_phases(query, db, cytoscape)
+            except Exception as inst:
+                print("%-6d %-10s %-20s failed: %s" % (factor, dbname, name, inst))
+                times = None
+            db.close()
+            if times is None:
+                continue
+            queries[dbname + ":" + name] = times
+            print("%-6d %-10s %-20s " % (factor, dbname, name) +
+                  " ".join("%12.6f" % times[phase] if phase in times else "%12s" % "-"
+                           for phase in PHASES))
+        results['results'][str(factor)] = queries
+    shutil.rmtree(tmpdir)
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+                                         results['commit'] + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print("\nsaved " + output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# Synthetic scale-up of the bundled databases: a copy at scale factor f holds
+# f versions of every row. Version k of a row keeps its non-key values, so
+# value distributions and predicate selectivities are unchanged, while its
+# key values are shifted (numbers by k*OFFSET, text suffixed with ~k) so keys
+# stay unique. Foreign keys - declared, or inferred from a column whose values
+# all occur in a key column of the same type - are shifted the same way, so
+# version k of a row references version k of its parent.
+#
+#   python benchmarks/scaleup.py [-s factor ...] [-o dir] [database ...]
+
+import argparse
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from RAP import *
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+# declared types, key columns and foreign keys of every table of dbfile,
+# from the same introspection SQLite3.open uses
+def read_schema(dbfile):
+    db = SQLite3()
+    db.open(dbfile)
+    conn = db.conn
+    tables = {}
+    for name, records in get_schema_catalog(dbfile, conn).items():
+        pk = [record[0] for record in sorted(records, key=lambda r: r[2]) if record[2] > 0]
+        keys = [pk] if pk else []
+        for index in conn.execute('pragma index_list("' + name + '")').fetchall():
+            if index[2]:
+                cols = [r[2] for r in conn.execute('pragma index_info("' + index[1] + '")')]
+                if cols not in keys:
+                    keys.append(cols)
+        fks = {}
+        for fk in conn.execute('pragma foreign_key_list("' + name + '")').fetchall():
+            fks[fk[3]] = (fk[2], fk[4])
+        tables[name] = {'types': {r[0]: r[1].upper() for r in records},
+                        'keys': keys, 'fks': fks}
+    # a parent column omitted from a foreign key is the parent's primary key
+    for table in tables.values():
+        for col, (parent, pcol) in list(table['fks'].items()):
+            if pcol is None and parent in tables and tables[parent]['keys']:
+                table['fks'][col] = (parent, tables[parent]['keys'][0][0])
+    infer_foreign_keys(conn, tables)
+    db.close()
+    return tables
+
+
+# undeclared references, such as a manager column holding employee keys
+def infer_foreign_keys(conn, tables):
+    single_keys = [(name, key[0]) for name, table in tables.items()
+                   for key in table['keys'] if len(key) == 1]
+    for name, table in tables.items():
+        keyed = set(col for key in table['keys'] for col in key)
+        for col, decl in table['types'].items():
+            if col in keyed or col in table['fks']:
+                continue
+            for parent, pcol in single_keys:
+                if (parent, pcol) == (name, col) or tables[parent]['types'][pcol] != decl:
+                    continue
+                missing = conn.execute(
+                    'select count(*) from "' + name + '" where "' + col + '" is not null and "' +
+                    col + '" not in (select "' + pcol + '" from "' + parent + '")').fetchone()[0]
+                present = conn.execute('select count(*) from "' + name + '" where "' + col +
+                                       '" is not null').fetchone()[0]
+                if missing == 0 and present > 0:
+                    table['fks'][col] = (parent, pcol)
+                    break
+
+
+# (table, column) pairs whose values are shifted in every version: single
+# column keys, foreign keys to shifted columns, and all columns of composite
+# keys that would otherwise not stay unique
+def shifted_columns(tables):
+    shifted = set()
+    changed = True
+    while changed:
+        changed = False
+        for name, table in tables.items():
+            for key in table['keys']:
+                if len(key) == 1 and (name, key[0]) not in shifted:
+                    shifted.add((name, key[0]))
+                    changed = True
+            for col, (parent, pcol) in table['fks'].items():
+                if (parent, pcol) in shifted and (name, col) not in shifted:
+                    shifted.add((name, col))
+                    changed = True
+        if changed:
+            continue
+        for name, table in tables.items():
+            for key in table['keys']:
+                if not any((name, col) in shifted for col in key):
+                    shifted.update((name, col) for col in key)
+                    changed = True
+    return shifted
+
+
+def shift_offset(conn, tables, shifted):
+    largest = 1
+    for name, col in shifted:
+        value = conn.execute('select max(abs("' + col + '")) from "' + name + '" where typeof("' +
+                             col + '") in (\'integer\', \'real\')').fetchone()[0]
+        if value is not None:
+            largest = max(largest, int(value))
+    return 10 ** len(str(largest))
+
+
+def shift_expression(col, offset):
+    return ('case when typeof("' + col + '") in (\'integer\', \'real\') then "' + col +
+            '" + k*' + str(offset) + ' when "' + col + '" is null then null else "' + col +
+            '" || \'~\' || k end')
+
+
+# write a copy of src scaled by factor to dst
+def scale_database(src, dst, factor):
+    if os.path.exists(dst):
+        os.remove(dst)
+    tables = read_schema(src)
+    shifted = shifted_columns(tables)
+    source = sqlite3.connect(src)
+    target = sqlite3.connect(dst)
+    source.backup(target)
+    offset = shift_offset(source, tables, shifted)
+    source.close()
+    # shifted keys may not satisfy CHECK constraints on codes
+    target.execute("pragma ignore_check_constraints = on")
+    target.execute("attach database ? as src", (src,))
+    for name, table in tables.items():
+        exprs = [shift_expression(col, offset) if (name, col) in shifted else '"' + col + '"'
+                 for col in table['types']]
+        # versions 1 .. factor-1 of every row, version 0 is the original
+        target.execute('with recursive versions(k) as (select 1 where ? > 0 union all '
+                       'select k+1 from versions where k < ?) insert into main."' + name +
+                       '" select ' + ', '.join(exprs) + ' from src."' + name + '", versions',
+                       (factor - 1, factor - 1))
+    target.commit()
+    target.execute("detach database src")
+    target.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Scale up the bundled databases")
+    ap.add_argument('databases', nargs='*', help="databases to scale (default: databases/*.db)")
+    ap.add_argument('-s', '--scale', type=int, action='append',
+                    help="scale factor (repeatable, default 10)")
+    ap.add_argument('-o', '--output', default='.', help="directory for the scaled copies")
+    args = ap.parse_args()
+    dbfiles = args.databases or sorted(
+        os.path.join(ROOT, 'databases', name) for name in os.listdir(os.path.join(ROOT, 'databases'))
+        if name.endswith('.db'))
+    os.makedirs(args.output, exist_ok=True)
+    for dbfile in dbfiles:
+        for factor in args.scale or [10]:
+            name = os.path.splitext(os.path.basename(dbfile))[0] + "_x" + str(factor) + ".db"
+            scale_database(dbfile, os.path.join(args.output, name), factor)
+            print(os.path.join(args.output, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Compare the native INTERSECT/EXCEPT translation of intersect and minus with
+# the previous "where (...) [not] in (select ...)" form, for every query in
+# queries.md that uses them, on scaled-up copies of the bundled databases.
+#
+#   python benchmarks/setops.py [scale factor ...]
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from RAP import *
+from common import ROOT, best_time, workload
+from scaleup import scale_database
+
+
+# the translation of an intersect/minus root used before native set operators
+def in_subquery_sql(tree, db):
+    lquery = generateSQL(tree.get_left_child(), db)
+    rquery = generateSQL(tree.get_right_child(), db)
+    if tree.get_left_child().get_node_type() == "union":
+        lquery = "(" + lquery + ")"
+    if tree.get_right_child().get_node_type() == "union":
+        rquery = "(" + rquery + ")"
+    operator = " in " if tree.get_node_type() == "intersect" else " not in "
+    return "select * from (" + lquery + ") " + tree.get_left_child().get_relation_name() + \
+        " where (" + ", ".join(tree.get_attributes()) + ")" + operator + \
+        "(select * from (" + rquery + ") " + tree.get_right_child().get_relation_name() + ")"
+
+
+# set operator nodes of tree, top down
+def set_operator_nodes(tree, nodes):
+    if tree is None:
+        return nodes
+    if tree.get_node_type() in ['intersect', 'minus']:
+        nodes.append(tree)
+    set_operator_nodes(tree.get_left_child(), nodes)
+    set_operator_nodes(tree.get_right_child(), nodes)
+    return nodes
+
+
+def main():
+    factors = [int(arg) for arg in sys.argv[1:]] or [1, 10, 100]
+    tmpdir = tempfile.mkdtemp()
+    print("%-10s %-6s %-6s %-10s %12s %12s %8s" %
+          ("database", "query", "scale", "operator", "in (s)", "native (s)", "rows"))
+    for factor in factors:
+        scaled = {}
+        for dbname, qnum, query in workload():
+            if dbname not in scaled:
+                scaled[dbname] = os.path.join(tmpdir, "%s_x%d.db" % (dbname, factor))
+                scale_database(os.path.join(ROOT, 'databases', dbname + '.db'),
+                               scaled[dbname], factor)
+            db = SQLite3()
+            db.open(scaled[dbname])
+            tree = parser.parse(query)
+            set_temp_table_names(tree)
+            if semantic_checks(tree, db) != 'OK':
+                db.close()
+                continue
+            for node in set_operator_nodes(tree, []):
+                old, old_rows = best_time(db.conn, in_subquery_sql(node, db))
+                new, new_rows = best_time(db.conn, generateSQL(node, db))
+                print("%-10s %-6d %-6d %-10s %12.4f %12.4f %8s" %
+                      (dbname, qnum, factor, node.get_node_type(), old, new,
+                       new_rows if old_rows == new_rows else "%d/%d" % (old_rows, new_rows)))
+            db.close()
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Cold-start cost of the CLI and the app: each case runs in a fresh Python
+# process, and the best and median wall times over REPEAT runs are printed.
+# Bytecode is written and an untimed run comes first, so that compiling the
+# modules is not counted, as in a deployed install.
+#
+#   python benchmarks/startup.py [repeat]
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+ENV = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+QUERY = "project[lname,fname](select[salary>30000](employee));"
+
+CASES = [
+    ("python", "pass"),
+    ("import RAP", "import RAP"),
+    ("import RAP + first parse", "import RAP; RAP.parser.parse(%r)" % QUERY),
+    ("import RAP + first query",
+     "import RAP; db = RAP.SQLite3(); db.open('databases/company.db'); "
+     "RAP.run_query(%r, db)" % QUERY),
+    ("import app", "import app"),
+]
+
+
+def run(code):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=ENV,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return elapsed
+
+
+def cli(repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, 'RAP.py', 'databases/company.db'], cwd=ROOT, env=ENV,
+                       input=QUERY + "\nq;\n", stdout=subprocess.DEVNULL, text=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print("%-28s %10s %10s" % ("case", "best (ms)", "median (ms)"))
+    for name, code in CASES:
+        try:
+            run(code)
+            times = [run(code) for _ in range(repeat)]
+        except RuntimeError as inst:
+            print("%-28s %s" % (name, inst))
+            continue
+        print("%-28s %10.1f %10.1f" % (name, min(times) * 1000, statistics.median(times) * 1000))
+    times = cli(repeat)
+    print("%-28s %10.1f %10.1f" % ("CLI, one query", min(times) * 1000,
+                                   statistics.median(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Concurrency stress test: every query of queries.md is parsed, checked,
+# turned into the app's JSON tree, optimized, run, and every node of its tree
+# is fetched the way the app does (materialized, optimized, first page). This
+# is done once serially for reference, then repeatedly from a thread pool in
+# shuffled order; every concurrent result must be identical to the reference.
+#
+#   python benchmarks/stress.py [threads] [rounds]
+
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from RAP import *
+from common import ROOT, workload
+
+
+def collect_ids(json_tree, ids):
+    if json_tree is not None:
+        ids.append(json_tree['node_id'])
+        collect_ids(json_tree['left_child'], ids)
+        collect_ids(json_tree['right_child'], ids)
+    return ids
+
+
+# everything a request could observe for query, as one JSON string
+def run_item(item):
+    dbname, query = item
+    db = SQLite3()
+    db.open(os.path.join(ROOT, 'databases', dbname + '.db'))
+    try:
+        tree = parser.parse(query)
+        set_temp_table_names(tree)
+        if semantic_checks(tree, db) != 'OK':
+            return None
+        sql = generateCTESQL(optimize_tree(tree, db), db)
+        records = db.conn.execute(sql).fetchall()
+        json_tree = generate_tree_from_query(query, db, [0], explain=True)
+        nodes = [get_node_info_from_db(node_id, json_tree, db, page=0, materialize=True,
+                                       optimize=True)
+                 for node_id in collect_ids(json_tree, [])]
+        return json.dumps([sql, records, json_tree, nodes], default=str)
+    finally:
+        db.close()
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    items = [(dbname, query) for dbname, _, query in workload()]
+    reference = [run_item(item) for item in items]
+
+    work = list(range(len(items))) * rounds
+    random.Random(0).shuffle(work)
+    result_cache.clear()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(lambda i: (i, run_item(items[i])), work))
+    elapsed = time.perf_counter() - start
+
+    bad = [i for i, result in results if result != reference[i]]
+    print("%d runs of %d queries on %d threads in %.2fs, %d mismatches" %
+          (len(work), len(items), threads, elapsed, len(bad)))
+    for i in sorted(set(bad)):
+        print("mismatch: " + items[i][0] + ": " + " ".join(items[i][1].split()))
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# lextab.py. This file automatically created by PLY (version 3.11). Don't edit!
+_tabversion   = '3.10'
+_lextokens    = set(('AND', 'COMMA', 'COMPARISION', 'COUNT', 'ID', 'INTERSECT', 'JOIN', 'LBRACKET', 'LIKE', 'LPARENT', 'MINUS', 'NUMBER', 'PROJECT', 'RBRACKET', 'RENAME', 'RPARENT', 'SELECT', 'SEMI', 'STRING', 'SUM', 'TIMES', 'UNION'))
+_lexreflags   = 64
+_lexliterals  = ''
+_lexstateinfo = {'INITIAL': 'inclusive'}
+_lexstatere   = {'INITIAL': [("(?P<t_STRING>'[^']*')|(?P<t_NUMBER>[-+]?[1-9][0-9]*(\\.([0-9]+)?)?)|(?P<t_ID>[a-zA-Z][_a-zA-Z0-9]*)|(?P<t_newline>[\\r\\n]+)|(?P<t_INTERSECT>[Ii][Nn][Tt][Ee][Rr][Ss][Ee][Cc][Tt])|(?P<t_PROJECT>[Pp][Rr][Oo][Jj][Ee][Cc][Tt])|(?P<t_RENAME>[Rr][Ee][Nn][Aa][Mm][Ee])|(?P<t_SELECT>[Ss][Ee][Ll][Ee][Cc][Tt])|(?P<t_UNION>[Uu][Nn][Ii][Oo][Nn])|(?P<t_MINUS>[Mm][Ii][Nn][Uu][Ss])|(?P<t_TIMES>[Tt][Ii][Mm][Ee][Ss])|(?P<t_JOIN>[Jj][Oo][Ii][Nn])|(?P<t_COMPARISION><>|<=|>=|<|>|=)|(?P<t_AND>[Aa][Nn][Dd])|(?P<t_ignore_COMMENT>\\#.*)|(?P<t_LPARENT>\\()|(?P<t_RPARENT>\\))|(?P<t_RBRACKET>\\])|(?P<t_LBRACKET>\\[)|(?P<t_SEMI>;)|(?P<t_COMMA>,)", [None, ('t_STRING', 'STRING'), ('t_NUMBER', 'NUMBER'), None, None, ('t_ID', 'ID'), ('t_newline', 'newline'), (None, 'INTERSECT'), (None, 'PROJECT'), (None, 'RENAME'), (None, 'SELECT'), (None, 'UNION'), (None, 'MINUS'), (None, 'TIMES'), (None, 'JOIN'), (None, 'COMPARISION'), (None, 'AND'), (None, None), (None, 'LPARENT'), (None, 'RPARENT'), (None, 'RBRACKET'), (None, 'LBRACKET'), (None, 'SEMI'), (None, 'COMMA')])]}
+_lexstateignore = {'INITIAL': ' \t'}
+_lexstateerrorf = {'INITIAL': 't_error'}
+_lexstateeoff = {}
@@ -27,37 +27,37 @@ for _k, _v in _lr_goto_items.items():
 del _lr_goto_items
 _lr_productions = [
   ("S' -> query","S'",1,None,None,None),
-  ('query -> expr SEMI','query',2,'p_query','RAP.py',95),
-  ('expr -> proj_expr','expr',1,'p_expr','RAP.py',100),
-  ('expr -> rename_expr','expr',1,'p_expr','RAP.py',101),
-  ('expr -> union_expr','expr',1,'p_expr','RAP.py',102),
-  ('expr -> minus_expr','expr',1,'p_expr','RAP.py',103),
-  ('expr -> intersect_expr','expr',1,'p_expr','RAP.py',104),
-  ('expr -> join_expr','expr',1,'p_expr','RAP.py',105),
-  ('expr -> times_expr','expr',1,'p_expr','RAP.py',106),
-  ('expr -> paren_expr','expr',1,'p_expr','RAP.py',107),
-  ('expr -> select_expr','expr',1,'p_expr','RAP.py',108),
-  ('expr -> ID','expr',1,'p_ID','RAP.py',113),
-  ('proj_expr -> PROJECT LBRACKET attr_list RBRACKET LPARENT expr RPARENT','proj_expr',7,'p_proj_expr','RAP.py',120),
-  ('rename_expr -> RENAME LBRACKET attr_list RBRACKET LPARENT expr RPARENT','rename_expr',7,'p_rename_expr','RAP.py',128),
-  ('attr_list -> ID','attr_list',1,'p_attr_list','RAP.py',135),
-  ('attr_list -> COUNT LPARENT ID RPARENT','attr_list',4,'p_attr_list','RAP.py',136),
-  ('attr_list -> SUM LPARENT ID RPARENT','attr_list',4,'p_attr_list','RAP.py',137),
-  ('attr_list -> attr_list COMMA ID','attr_list',3,'p_attr_list_2','RAP.py',145),
-  ('attr_list -> attr_list COMMA COUNT LPARENT ID RPARENT','attr_list',6,'p_attr_list_2','RAP.py',146),
-  ('attr_list -> attr_list COMMA SUM LPARENT ID RPARENT','attr_list',6,'p_attr_list_2','RAP.py',147),
-  ('union_expr -> expr UNION expr','union_expr',3,'p_union_expr','RAP.py',155),
-  ('minus_expr -> expr MINUS expr','minus_expr',3,'p_minus_expr','RAP.py',161),
-  ('intersect_expr -> expr INTERSECT expr','intersect_expr',3,'p_intersect_expr','RAP.py',167),
-  ('join_expr -> expr JOIN expr','join_expr',3,'p_join_expr','RAP.py',173),
-  ('times_expr -> expr TIMES expr','times_expr',3,'p_times_expr','RAP.py',179),
-  ('paren_expr -> LPARENT expr RPARENT','paren_expr',3,'p_paren_expr','RAP.py',185),
-  ('select_expr -> SELECT LBRACKET condition RBRACKET LPARENT expr RPARENT','select_expr',7,'p_select_expr','RAP.py',190),
-  ('condition -> simple_condition','condition',1,'p_condition','RAP.py',197),
-  ('condition -> condition AND simple_condition','condition',3,'p_condition_2','RAP.py',202),
-  ('simple_condition -> operand COMPARISION operand','simple_condition',3,'p_simple_condition','RAP.py',207),
-  ('simple_condition -> operand LIKE operand','simple_condition',3,'p_simple_condition','RAP.py',208),
-  ('operand -> ID','operand',1,'p_operand_1','RAP.py',213),
-  ('operand -> STRING','operand',1,'p_operand_2','RAP.py',218),
-  ('operand -> NUMBER','operand',1,'p_operand_3','RAP.py',223),
+  ('query -> expr SEMI','query',2,'p_query','RAP.py',102),
+  ('expr -> proj_expr','expr',1,'p_expr','RAP.py',107),
+  ('expr -> rename_expr','expr',1,'p_expr','RAP.py',108),
+  ('expr -> union_expr','expr',1,'p_expr','RAP.py',109),
+  ('expr -> minus_expr','expr',1,'p_expr','RAP.py',110),
+  ('expr -> intersect_expr','expr',1,'p_expr','RAP.py',111),
+  ('expr -> join_expr','expr',1,'p_expr','RAP.py',112),
+  ('expr -> times_expr','expr',1,'p_expr','RAP.py',113),
+  ('expr -> paren_expr','expr',1,'p_expr','RAP.py',114),
+  ('expr -> select_expr','expr',1,'p_expr','RAP.py',115),
+  ('expr -> ID','expr',1,'p_ID','RAP.py',120),
+  ('proj_expr -> PROJECT LBRACKET attr_list RBRACKET LPARENT expr RPARENT','proj_expr',7,'p_proj_expr','RAP.py',127),
+  ('rename_expr -> RENAME LBRACKET attr_list RBRACKET LPARENT expr RPARENT','rename_expr',7,'p_rename_expr','RAP.py',135),
+  ('attr_list -> ID','attr_list',1,'p_attr_list','RAP.py',142),
+  ('attr_list -> COUNT LPARENT ID RPARENT','attr_list',4,'p_attr_list','RAP.py',143),
+  ('attr_list -> SUM LPARENT ID RPARENT','attr_list',4,'p_attr_list','RAP.py',144),
+  ('attr_list -> attr_list COMMA ID','attr_list',3,'p_attr_list_2','RAP.py',152),
+  ('attr_list -> attr_list COMMA COUNT LPARENT ID RPARENT','attr_list',6,'p_attr_list_2','RAP.py',153),
+  ('attr_list -> attr_list COMMA SUM LPARENT ID RPARENT','attr_list',6,'p_attr_list_2','RAP.py',154),
+  ('union_expr -> expr UNION expr','union_expr',3,'p_union_expr','RAP.py',162),
+  ('minus_expr -> expr MINUS expr','minus_expr',3,'p_minus_expr','RAP.py',168),
+  ('intersect_expr -> expr INTERSECT expr','intersect_expr',3,'p_intersect_expr','RAP.py',174),
+  ('join_expr -> expr JOIN expr','join_expr',3,'p_join_expr','RAP.py',180),
+  ('times_expr -> expr TIMES expr','times_expr',3,'p_times_expr','RAP.py',186),
+  ('paren_expr -> LPARENT expr RPARENT','paren_expr',3,'p_paren_expr','RAP.py',192),
+  ('select_expr -> SELECT LBRACKET condition RBRACKET LPARENT expr RPARENT','select_expr',7,'p_select_expr','RAP.py',197),
+  ('condition -> simple_condition','condition',1,'p_condition','RAP.py',204),
+  ('condition -> condition AND simple_condition','condition',3,'p_condition_2','RAP.py',209),
+  ('simple_condition -> operand COMPARISION operand','simple_condition',3,'p_simple_condition','RAP.py',214),
+  ('simple_condition -> operand LIKE operand','simple_condition',3,'p_simple_condition','RAP.py',215),
+  ('operand -> ID','operand',1,'p_operand_1','RAP.py',220),
+  ('operand -> STRING','operand',1,'p_operand_2','RAP.py',225),
+  ('operand -> NUMBER','operand',1,'p_operand_3','RAP.py',230),
 ]